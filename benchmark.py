@@ -0,0 +1,292 @@
+import sys
+import os
+import argparse
+import contextlib
+import json
+import platform
+import shutil
+import tempfile
+import time
+import cv2 as cv
+import numpy as np
+import pandas as pd
+
+# Navigation runs a real MainWindow without a display
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import video_labeling
+
+def timeCall(function, repeat=1):
+    # Seconds taken by each call, the result of the last call is returned too
+    seconds = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        seconds.append(time.perf_counter() - start)
+    return summarize(seconds), result
+
+def summarize(seconds):
+    seconds = np.asarray(seconds, dtype=np.float64)
+    return {
+        "count": len(seconds),
+        "total": float(seconds.sum()),
+        "min": float(seconds.min()),
+        "median": float(np.median(seconds)),
+        "mean": float(seconds.mean()),
+        "p95": float(np.percentile(seconds, 95)),
+        "max": float(seconds.max())
+    }
+
+def makeVideo(video_path, codec, size, frames_count, gop):
+    # Moving shapes over a textured background, so codecs have real work to do
+    params = []
+    if hasattr(cv, "VIDEOWRITER_PROP_KEY_INTERVAL"):
+        params = [cv.VIDEOWRITER_PROP_KEY_INTERVAL, gop]
+
+    writer = cv.VideoWriter(video_path, cv.CAP_ANY, cv.VideoWriter_fourcc(*codec), 25, size, params)
+    if not writer.isOpened():
+        return False
+
+    width, height = size
+    rng = np.random.default_rng(0)
+    background = rng.integers(0, 255, (height // 8 + 1, width // 8 + 1, 3), dtype=np.uint8)
+    background = cv.resize(background, (width, height), interpolation=cv.INTER_NEAREST)
+
+    for frame_id in range(frames_count):
+        image = np.roll(background, frame_id, axis=1)
+        for i in range(8):
+            x = (frame_id * (i + 1) * 3 + i * width // 8) % width
+            y = (i * height // 8 + frame_id) % height
+            cv.rectangle(image, (x, y), (x + width // 10, y + height // 10), (255 - i * 30, i * 30, 128), -1)
+        writer.write(image)
+
+    writer.release()
+    return True
+
+def makeDataset(csv_path, rows, video_paths, frames_count):
+    rng = np.random.default_rng(rows)
+    tag_ids = rng.integers(1, 5, rows)
+    df = pd.DataFrame({
+        "x": rng.integers(0, 1800, rows, dtype=np.int32),
+        "y": rng.integers(0, 1000, rows, dtype=np.int32),
+        "w": rng.integers(10, 120, rows, dtype=np.int32),
+        "h": rng.integers(10, 120, rows, dtype=np.int32),
+        "tag_id": tag_ids,
+        "tag_name": np.array(["tag1", "tag2", "tag3", "tag4"], dtype=object)[tag_ids - 1],
+        "frame_id": rng.integers(0, frames_count, rows, dtype=np.int32),
+        "file_name": np.array(video_paths, dtype=object)[rng.integers(0, len(video_paths), rows)]
+    }, columns=video_labeling.TagDataset.headers)
+    df.to_csv(csv_path, index=False)
+
+def benchDataset(work_dir, rows, video_paths, frames_count, queries=1000):
+    results = []
+
+    csv_path = os.path.join(work_dir, "dataset_{}.csv".format(rows))
+    makeDataset(csv_path, rows, video_paths, frames_count)
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        stats, tags_dataset = timeCall(lambda: loadDataset(csv_path))
+        results.append({"benchmark": "dataset.load_csv", "rows": rows, "seconds": stats})
+
+        stats, _ = timeCall(lambda: tags_dataset.saveDataset(os.path.join(work_dir, "saved.csv")))
+        results.append({"benchmark": "dataset.save_csv", "rows": rows, "seconds": stats})
+
+        vlb_path = os.path.join(work_dir, "saved.vlb")
+        stats, _ = timeCall(lambda: tags_dataset.saveDataset(vlb_path))
+        results.append({"benchmark": "dataset.save_vlb", "rows": rows, "seconds": stats})
+
+        stats, _ = timeCall(lambda: loadDataset(vlb_path))
+        results.append({"benchmark": "dataset.load_vlb", "rows": rows, "seconds": stats})
+
+    # Random frames, most of them with bboxes on large datasets
+    rng = np.random.default_rng(1)
+    file_names = np.array(video_paths, dtype=object)[rng.integers(0, len(video_paths), queries)]
+    frame_ids = rng.integers(0, frames_count, queries)
+    seconds = []
+    for file_name, frame_id in zip(file_names.tolist(), frame_ids.tolist()):
+        stats, _ = timeCall(lambda: tags_dataset.getFrameBBoxs(file_name, frame_id))
+        seconds.append(stats["total"])
+    results.append({"benchmark": "dataset.get_frame_bboxs", "rows": rows, "seconds": summarize(seconds)})
+
+    os.remove(csv_path)
+    return results, tags_dataset
+
+def loadDataset(file_path):
+    tags_dataset = video_labeling.TagDataset()
+    tags_dataset.loadDataset(file_path, chunk_size=100000)
+    return tags_dataset
+
+def showFrame(app, window, frame_id, timeout=10):
+    # Seconds until the frame is on the image label
+    shown = []
+    window.image_label.setFrame = lambda image, image_size: shown.append(video_labeling.Label.setFrame(window.image_label, image, image_size))
+
+    start = time.perf_counter()
+    window.curr_frame = frame_id
+    window.moveToCurrFrame()
+    while len(shown) == 0 and time.perf_counter() - start < timeout:
+        app.processEvents()
+    seconds = time.perf_counter() - start
+
+    del window.image_label.setFrame
+    return seconds if len(shown) > 0 else None
+
+def benchNavigation(app, window, video_path, frames_count, random_count=50):
+    results = []
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        window.openVideo(video_path)
+
+        # Seeks use the keyframes index once it is scanned
+        start = time.perf_counter()
+        while window.video_index is None and time.perf_counter() - start < 60:
+            app.processEvents()
+            time.sleep(0.01)
+
+        # Fresh cache for each run
+        window.frame_provider.setCacheSize(0)
+        window.frame_provider.setCacheSize(window.frame_cache_size_mb)
+
+        sequential_seconds = [showFrame(app, window, frame_id) for frame_id in range(frames_count)]
+
+        window.frame_provider.setCacheSize(0)
+        window.frame_provider.setCacheSize(window.frame_cache_size_mb)
+
+        rng = np.random.default_rng(2)
+        random_frames = rng.integers(0, frames_count, random_count).tolist()
+        random_seconds = [showFrame(app, window, frame_id) for frame_id in random_frames]
+
+    keyframes = len(window.video_index.keyframes) if window.video_index is not None else None
+    for name, seconds in [("navigation.sequential", sequential_seconds), ("navigation.random", random_seconds)]:
+        failed = sum(1 for s in seconds if s is None)
+        results.append({
+            "benchmark": name,
+            "video": os.path.basename(video_path),
+            "keyframes": keyframes,
+            "failed": failed,
+            "seconds": summarize([s for s in seconds if s is not None] or [0.0])
+        })
+
+    return results
+
+def benchExport(work_dir, tags_dataset, workers):
+    results = []
+    for workers_count in sorted(set([1, workers])):
+        export_dir = os.path.join(work_dir, "export_{}".format(workers_count))
+        exporter = video_labeling.YoloExporter(export_dir, "benchmark_dataset", workers=workers_count, incremental=False, sink="dir")
+
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            stats, _ = timeCall(lambda: exporter.export(tags_dataset))
+
+        results.append({"benchmark": "export.yolo", "rows": len(tags_dataset), "workers": workers_count, "seconds": stats})
+        shutil.rmtree(export_dir, ignore_errors=True)
+
+    return results
+
+def getEnvironment():
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "opencv": cv.__version__,
+        "numpy": np.__version__,
+        "pandas": pd.__version__
+    }
+
+# Sweeps of the full and --quick runs, options given on the command line are used as given
+full_defaults = {
+    "rows": [1000, 100000, 1000000, 10000000],
+    "codecs": ["MJPG:avi", "mp4v:mp4", "XVID:avi"],
+    "resolutions": ["640x360", "1280x720", "1920x1080"],
+    "gops": [12, 250],
+    "frames": 300,
+    "export_rows": 5000
+}
+quick_defaults = {
+    "rows": [1000, 100000],
+    "codecs": ["MJPG:avi"],
+    "resolutions": ["640x360"],
+    "gops": [12],
+    "frames": 100,
+    "export_rows": 1000
+}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark datasets, navigation and export on synthetic data")
+    parser.add_argument("--output", default="benchmark_results.json", help="results JSON file (default: benchmark_results.json)")
+    parser.add_argument("--rows", type=int, nargs="+", help="dataset sizes in bboxes (default: 1000 100000 1000000 10000000)")
+    parser.add_argument("--codecs", nargs="+", help="video codecs as fourcc:extension (default: MJPG:avi mp4v:mp4 XVID:avi)")
+    parser.add_argument("--resolutions", nargs="+", help="video resolutions (default: 640x360 1280x720 1920x1080)")
+    parser.add_argument("--gops", type=int, nargs="+", help="keyframe intervals (default: 12 250)")
+    parser.add_argument("--frames", type=int, help="frames per video (default: 300)")
+    parser.add_argument("--export-rows", type=int, help="bboxes in the exported dataset (default: 5000)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="export processes (default: number of CPUs)")
+    parser.add_argument("--quick", action="store_true", help="defaults to small sizes, one codec, one resolution and one keyframe interval")
+    args = parser.parse_args(argv)
+
+    defaults = quick_defaults if args.quick else full_defaults
+    for name, value in defaults.items():
+        if getattr(args, name) is None:
+            setattr(args, name, value)
+
+    output_path = os.path.abspath(args.output)
+    work_dir = tempfile.mkdtemp(prefix="video_labeling_benchmark_")
+    cwd = os.getcwd()
+    results = []
+
+    try:
+        # MainWindow reads labels.txt and writes its autosave in the working directory
+        os.chdir(work_dir)
+        with open("labels.txt", "w") as f:
+            f.write("1,tag1\n2,tag2\n3,tag3\n4,tag4\n")
+
+        video_paths = []
+        for codec in args.codecs:
+            fourcc, extension = codec.split(":")
+            for resolution in args.resolutions:
+                width, height = [int(value) for value in resolution.split("x")]
+                for gop in args.gops:
+                    video_path = os.path.join(work_dir, "{}_{}_gop{}.{}".format(fourcc, resolution, gop, extension))
+                    print("Writing {}".format(os.path.basename(video_path)))
+                    if makeVideo(video_path, fourcc, (width, height), args.frames, gop):
+                        video_paths.append(video_path)
+                    else:
+                        print("Cannot write {} videos".format(fourcc))
+
+        for rows in args.rows:
+            print("Dataset with {} bboxes".format(rows))
+            dataset_results, _ = benchDataset(work_dir, rows, video_paths, args.frames)
+            results += dataset_results
+
+        app = video_labeling.QApplication.instance() or video_labeling.QApplication(sys.argv[:1])
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            window = video_labeling.MainWindow()
+        window.show()
+        for video_path in video_paths:
+            print("Navigating {}".format(os.path.basename(video_path)))
+            results += benchNavigation(app, window, video_path, args.frames)
+        window.close()
+
+        print("Exporting {} bboxes".format(args.export_rows))
+        _, tags_dataset = benchDataset(work_dir, args.export_rows, video_paths, args.frames, queries=1)
+        results += benchExport(work_dir, tags_dataset, args.workers)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": getEnvironment(),
+        "config": vars(args),
+        "results": results
+    }
+    with open(output_path, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for result in results:
+        print("{:<28} {:>10} {:>12.6f} s".format(result["benchmark"], result.get("rows", result.get("video", "")), result["seconds"]["median"]))
+    print("Results written to {}".format(output_path))
+
+if __name__ == "__main__":
+    main()
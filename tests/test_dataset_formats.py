@@ -0,0 +1,119 @@
+import filecmp
+
+import numpy as np
+import pandas as pd
+import pytest
+from PySide2.QtCore import QRect
+
+from video_labeling import BBoxTag, Tag, TagDataset
+
+
+# Names the CSV writer has to quote or the reader could take for missing values
+odd_names = ["plain", "with,comma", 'with "quotes"', '""', "NA", "N/A", "null"]
+
+def makeDataset(count=50, tag_names=None, file_names=None):
+    tag_names = tag_names if tag_names is not None else ["car", "person"]
+    file_names = file_names if file_names is not None else ["/videos/a.mp4", "/videos/b.mp4"]
+
+    rng = np.random.default_rng(0)
+    tag_indexes = rng.integers(0, len(tag_names), count)
+    dataset = TagDataset()
+    dataset.appendColumns(
+        rng.integers(0, 1000, count), rng.integers(0, 1000, count),
+        rng.integers(1, 100, count), rng.integers(1, 100, count),
+        tag_indexes + 1, np.array(tag_names, dtype=object)[tag_indexes],
+        rng.integers(0, 500, count),
+        np.array(file_names, dtype=object)[rng.integers(0, len(file_names), count)])
+    return dataset
+
+def loadDataset(file_path):
+    dataset = TagDataset()
+    dataset.loadDataset(file_path)
+    return dataset
+
+def makeBBoxTag(x, y, w, h, tag, frame_id, file_name):
+    bbox_tag = BBoxTag()
+    bbox_tag.setValues(QRect(x, y, w, h), tag, frame_id, file_name)
+    return bbox_tag
+
+def assertSameBBoxes(dataset, other, with_ids=False):
+    pd.testing.assert_frame_equal(dataset.getDataFrame(with_ids), other.getDataFrame(with_ids), check_dtype=False)
+
+def test_csv_binary_csv_round_trip_is_byte_identical(tmp_path):
+    makeDataset().saveDataset(str(tmp_path / "first.csv"))
+
+    loadDataset(str(tmp_path / "first.csv")).saveDataset(str(tmp_path / "data.vlb"))
+    loadDataset(str(tmp_path / "data.vlb")).saveDataset(str(tmp_path / "second.csv"))
+
+    assert filecmp.cmp(str(tmp_path / "first.csv"), str(tmp_path / "second.csv"), shallow=False)
+
+@pytest.mark.parametrize("extension", ["csv", "vlb"])
+def test_empty_dataset_round_trip(tmp_path, extension):
+    file_path = str(tmp_path / ("empty." + extension))
+    TagDataset().saveDataset(file_path)
+
+    dataset = loadDataset(file_path)
+
+    assert len(dataset) == 0
+    assert list(dataset.getDataFrame().columns) == TagDataset.headers
+
+    # Bboxes can be added after loading nothing
+    dataset.addTag(makeBBoxTag(1, 2, 3, 4, Tag(1, "car"), 5, "/videos/a.mp4"))
+    assert len(dataset) == 1
+
+@pytest.mark.parametrize("extension", ["csv", "vlb"])
+def test_names_are_kept_as_written(tmp_path, extension):
+    dataset = makeDataset(tag_names=odd_names, file_names=odd_names)
+    file_path = str(tmp_path / ("names." + extension))
+    dataset.saveDataset(file_path)
+
+    loaded = loadDataset(file_path)
+
+    assertSameBBoxes(dataset, loaded)
+    assert set(tag.name for tag in loaded.tags) == set(odd_names)
+    assert set(loaded.file_names) == set(odd_names)
+
+def test_binary_keeps_bbox_ids(tmp_path):
+    dataset = makeDataset()
+    for bbox_id in range(0, 50, 3):
+        dataset.deleteBBoxTag(dataset.getBBoxTag(bbox_id))
+    dataset.saveDataset(str(tmp_path / "ids.vlb"))
+
+    loaded = loadDataset(str(tmp_path / "ids.vlb"))
+
+    assertSameBBoxes(dataset, loaded, with_ids=True)
+    assert loaded.getBBoxTag(0) is None
+    assert loaded.getBBoxTag(1).rect == dataset.getBBoxTag(1).rect
+
+    # New bboxes do not reuse the ids of the loaded ones
+    bbox_tag = makeBBoxTag(1, 2, 3, 4, Tag(1, "car"), 5, "/videos/a.mp4")
+    loaded.addTag(bbox_tag)
+    assert bbox_tag.id == 50
+
+def test_changes_to_a_mapped_dataset(tmp_path):
+    file_path = str(tmp_path / "mapped.vlb")
+    makeDataset().saveDataset(file_path)
+    with open(file_path, "rb") as f:
+        file_data = f.read()
+
+    dataset = loadDataset(file_path)
+    expected = loadDataset(file_path).getDataFrame(with_ids=True).set_index("id")
+
+    target_tag = dataset.getBBoxTag(7)
+    dataset.updateBBoxTag(target_tag, makeBBoxTag(11, 12, 13, 14, Tag(2, "person"), 499, "/videos/c.mp4"))
+    expected.loc[7] = [11, 12, 13, 14, 2, "person", 499, "/videos/c.mp4"]
+
+    dataset.deleteBBoxTag(dataset.getBBoxTag(8))
+    expected = expected.drop(8)
+
+    bbox_tag = makeBBoxTag(21, 22, 23, 24, Tag(1, "car"), 3, "/videos/a.mp4")
+    dataset.addTag(bbox_tag)
+    expected.loc[bbox_tag.id] = [21, 22, 23, 24, 1, "car", 3, "/videos/a.mp4"]
+
+    pd.testing.assert_frame_equal(dataset.getDataFrame(with_ids=True).set_index("id"), expected, check_dtype=False)
+    assert [bbox.id for bbox in dataset.getFrameBBoxs("/videos/c.mp4", 499)] == [7]
+    assert dataset.getBBoxTag(8) is None
+
+    # Mapped columns are copy-on-write, the file is left as it was
+    with open(file_path, "rb") as f:
+        assert f.read() == file_data
@@ -0,0 +1,132 @@
+import json
+import os
+import tarfile
+import zipfile
+
+import cv2 as cv
+import numpy as np
+import pytest
+from PySide2.QtCore import QRect
+
+from video_labeling import BBoxTag, JobCancelled, Tag, TagDataset, YoloExporter
+
+
+sinks = [("dir", False), ("zip", False), ("zip", True), ("tar", False), ("tar", True)]
+
+def makeVideo(file_path, frame_count=40):
+    # Every frame differs, a square moves over a gradient
+    writer = cv.VideoWriter(file_path, cv.CAP_ANY, cv.VideoWriter_fourcc(*"MJPG"), 25, (64, 48))
+    for frame_id in range(frame_count):
+        image = np.zeros((48, 64, 3), dtype=np.uint8)
+        image[:, :, 0] = np.arange(64, dtype=np.uint8) * 4
+        image[8:24, frame_id:frame_id + 16] = 255
+        writer.write(image)
+    writer.release()
+
+def makeDataset(video_path, frame_ids):
+    count = len(frame_ids)
+    dataset = TagDataset()
+    dataset.appendColumns(
+        np.arange(count) % 20, np.full(count, 10), np.full(count, 16), np.full(count, 12),
+        np.ones(count, dtype=int), np.full(count, "car", dtype=object),
+        np.array(frame_ids), np.full(count, video_path, dtype=object))
+    return dataset
+
+def makeBBoxTag(x, y, w, h, tag, frame_id, file_name):
+    bbox_tag = BBoxTag()
+    bbox_tag.setValues(QRect(x, y, w, h), tag, frame_id, file_name)
+    return bbox_tag
+
+def editDataset(dataset, video_path):
+    # Moved, deleted and added bboxes, frames dropped and new frames
+    target_tag = dataset.getFrameBBoxs(video_path, 2)[0]
+    dataset.updateBBoxTag(target_tag, makeBBoxTag(30, 20, 10, 10, Tag(1, "car"), 2, video_path))
+    for frame_id in (4, 5, 30):
+        for bbox_tag in dataset.getFrameBBoxs(video_path, frame_id):
+            dataset.deleteBBoxTag(bbox_tag)
+    dataset.addTag(makeBBoxTag(40, 30, 8, 8, Tag(2, "person"), 6, video_path))
+    for frame_id in (1, 15, 39):
+        dataset.addTag(makeBBoxTag(5, 5, 20, 20, Tag(1, "car"), frame_id, video_path))
+
+def makeExporter(base_dir, sink, compress, incremental=True):
+    return YoloExporter(base_dir, "ds", frames_per_job=5, sink=sink, compress=compress, incremental=incremental)
+
+def readFiles(exporter):
+    # Every file of the exported dataset by its path in the sink
+    if exporter.sink == "dir":
+        files = {}
+        for dir_path, _, file_names in os.walk(os.path.join(exporter.base_dir, exporter.dataset_name)):
+            for file_name in file_names:
+                file_path = os.path.join(dir_path, file_name)
+                with open(file_path, "rb") as f:
+                    files[os.path.relpath(file_path, exporter.base_dir)] = f.read()
+        return files
+
+    if exporter.sink == "zip":
+        with zipfile.ZipFile(exporter.outputPath()) as archive:
+            return {name: archive.read(name) for name in archive.namelist() if not name.endswith("/")}
+
+    # Later tar members replace the earlier ones with the same name
+    with tarfile.open(exporter.outputPath()) as archive:
+        return {member.name: archive.extractfile(member).read() for member in archive.getmembers() if member.isfile()}
+
+def readFrames(exporter):
+    # Image and label of every frame of the manifest, the dataset files are
+    # only these ones, and their frame numbering can differ between exports
+    files = readFiles(exporter)
+    manifest = json.loads(files.pop(exporter.manifestPath()))
+
+    frames = {}
+    for key, entry in manifest["frames"].items():
+        frames[key] = (files.pop(entry["image"]), files.pop(entry["label"]))
+
+    assert list(files) == []
+    return frames
+
+@pytest.mark.parametrize("sink,compress", sinks)
+def test_incremental_export_matches_a_full_export(tmp_path, sink, compress):
+    video_path = str(tmp_path / "video.avi")
+    makeVideo(video_path)
+    dataset = makeDataset(video_path, list(range(0, 40, 2)))
+
+    exporter = makeExporter(str(tmp_path / "incremental"), sink, compress)
+    exporter.export(dataset)
+    editDataset(dataset, video_path)
+    exporter.export(dataset)
+
+    full_exporter = makeExporter(str(tmp_path / "full"), sink, compress, incremental=False)
+    full_exporter.export(dataset)
+
+    frames = readFrames(exporter)
+    assert len(frames) == 21
+    assert frames == readFrames(full_exporter)
+
+    # Nothing changed, nothing is exported again
+    assert exporter.export(dataset)[:2] == (0, 21)
+    assert readFrames(exporter) == frames
+
+@pytest.mark.parametrize("sink,compress", [sink for sink in sinks if sink[0] != "dir"])
+def test_cancelled_export_leaves_the_archive_as_it_was(tmp_path, sink, compress):
+    video_path = str(tmp_path / "video.avi")
+    makeVideo(video_path)
+    dataset = makeDataset(video_path, list(range(0, 40, 2)))
+
+    exporter = makeExporter(str(tmp_path), sink, compress)
+    exporter.export(dataset)
+    with open(exporter.outputPath(), "rb") as f:
+        archive_data = f.read()
+
+    # Cancelled once the first job of changed frames is written
+    editDataset(dataset, video_path)
+    calls = []
+    def progressCallback(done, total):
+        calls.append(done)
+        if len(calls) == 1:
+            raise JobCancelled()
+
+    with pytest.raises(JobCancelled):
+        exporter.export(dataset, progress_callback=progressCallback)
+
+    with open(exporter.outputPath(), "rb") as f:
+        assert f.read() == archive_data
+    assert sorted(os.listdir(str(tmp_path))) == sorted(["video.avi", os.path.basename(exporter.outputPath())])
@@ -0,0 +1,103 @@
+import os
+
+import pandas as pd
+from PySide2.QtCore import QRect
+
+from video_labeling import BBoxTag, Tag, TagDataset
+
+
+def makeBBoxTag(x, y, w, h, tag, frame_id, file_name):
+    bbox_tag = BBoxTag()
+    bbox_tag.setValues(QRect(x, y, w, h), tag, frame_id, file_name)
+    return bbox_tag
+
+def openDataset(snapshot_path):
+    dataset = TagDataset()
+    assert dataset.openJournal(snapshot_path)
+    return dataset
+
+def crash(dataset):
+    # The journal is left as it is, only its lock is released as by the OS
+    dataset.journal.close()
+    dataset.journal = None
+
+def editDataset(dataset, first_frame):
+    # Journaled add, update and delete
+    for frame_id in range(first_frame, first_frame + 5):
+        dataset.addTag(makeBBoxTag(10 + frame_id, 20, 30, 40, Tag(1, "car"), frame_id, "/videos/a.mp4"))
+
+    target_tag = dataset.getFrameBBoxs("/videos/a.mp4", first_frame)[0]
+    dataset.updateBBoxTag(target_tag, makeBBoxTag(1, 2, 3, 4, Tag(2, "person"), first_frame, "/videos/a.mp4"))
+    dataset.deleteBBoxTag(dataset.getFrameBBoxs("/videos/a.mp4", first_frame + 1)[0])
+
+def assertSameBBoxes(dataset, other):
+    pd.testing.assert_frame_equal(dataset.getDataFrame(with_ids=True), other.getDataFrame(with_ids=True), check_dtype=False)
+
+def test_changes_are_restored_after_a_crash(tmp_path):
+    snapshot_path = str(tmp_path / "autosave" / "dataset.csv")
+    dataset = openDataset(snapshot_path)
+    editDataset(dataset, 0)
+    crash(dataset)
+
+    restored = openDataset(snapshot_path)
+
+    assertSameBBoxes(dataset, restored)
+    assert restored.journal.changes_count == 7
+
+def test_crash_before_the_old_journal_is_removed(tmp_path, monkeypatch):
+    snapshot_path = str(tmp_path / "dataset.csv")
+    dataset = openDataset(snapshot_path)
+    editDataset(dataset, 0)
+
+    # The snapshot replaces the previous one, then the process dies before
+    # the journal it contains is removed
+    journal = dataset.journal
+    remove = os.remove
+    def failingRemove(path):
+        if path == journal.old_journal_path:
+            raise OSError("crashed")
+        remove(path)
+    monkeypatch.setattr(os, "remove", failingRemove)
+    journal.snapshot(dataset, wait=True)
+    monkeypatch.undo()
+
+    assert os.path.exists(journal.old_journal_path)
+    editDataset(dataset, 10)
+    crash(dataset)
+
+    # The old journal is replayed over the snapshot that has its changes already
+    restored = openDataset(snapshot_path)
+    assertSameBBoxes(dataset, restored)
+
+    # The next snapshot takes both journals
+    restored.journal.snapshot(restored, wait=True)
+    assert not os.path.exists(journal.old_journal_path)
+    crash(restored)
+    assertSameBBoxes(dataset, openDataset(snapshot_path))
+
+def test_cleared_dataset_is_not_restored_with_old_changes(tmp_path):
+    snapshot_path = str(tmp_path / "dataset.csv")
+    dataset = openDataset(snapshot_path)
+    editDataset(dataset, 0)
+    dataset.clear()
+    dataset.addTag(makeBBoxTag(5, 6, 7, 8, Tag(1, "car"), 3, "/videos/b.mp4"))
+    crash(dataset)
+
+    restored = openDataset(snapshot_path)
+
+    assertSameBBoxes(dataset, restored)
+    assert len(restored) == 1
+
+def test_journal_is_used_by_one_dataset_at_a_time(tmp_path):
+    snapshot_path = str(tmp_path / "dataset.csv")
+    dataset = openDataset(snapshot_path)
+    editDataset(dataset, 0)
+
+    other = TagDataset()
+    assert not other.openJournal(snapshot_path)
+    assert other.journal is None
+    assert len(other) == 0
+
+    dataset.journal.close()
+    assert other.openJournal(snapshot_path)
+    assertSameBBoxes(dataset, other)
@@ -1,11 +1,35 @@
 import sys
 import os
+import argparse
+import json
+import sqlite3
+import io
+import zipfile
+import tarfile
+import time
+from collections import deque
 import shutil
 import cv2 as cv
 import csv
+import numpy as np
 import pandas as pd
-
-from PySide2.QtCore import Qt, QSize, QPoint, QRect, Signal, QDir
+import threading
+import bisect
+import contextlib
+import functools
+import hashlib
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+from PySide2.QtCore import Qt, QSize, QPoint, QRect, Signal, QDir, QThread, QTimer, QObject, QRunnable, QThreadPool
 from PySide2.QtGui import QIcon, QImage, QPixmap, QPainter, QPen
 from PySide2.QtWidgets import (
     QApplication, 
@@ -22,37 +46,181 @@ from PySide2.QtWidgets import (
     QInputDialog,
     QSlider,
     QListWidget,
-    QMessageBox
+    QListWidgetItem,
+    QMessageBox,
+    QProgressDialog,
+    QDialog,
+    QTableWidget,
+    QTableWidgetItem,
+    QCheckBox,
+    QProgressBar
 )
 
+class Metrics():
+
+    # Latency histogram buckets, bucket i counts the spans up to bucket_bounds[i]
+    # seconds and the last one the longer spans
+    bucket_bounds = [1e-6 * 2 ** i for i in range(28)]
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def span(self, name):
+        # Context manager timing its block, a shared no-op one when disabled
+        if not self.enabled:
+            return null_span
+        return TimingSpan(self, name)
+
+    def record(self, name, seconds):
+        bucket = bisect.bisect_left(self.bucket_bounds, seconds)
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = {"count": 0, "total": 0.0, "max": 0.0, "buckets": [0] * (len(self.bucket_bounds) + 1)}
+                self.histograms[name] = histogram
+            histogram["count"] += 1
+            histogram["total"] += seconds
+            histogram["max"] = max(histogram["max"], seconds)
+            histogram["buckets"][bucket] += 1
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+    def percentile(self, histogram, q):
+        # Upper bound of the bucket holding the q percentile
+        rank = q / 100 * histogram["count"]
+        seen = 0
+        for bucket, count in enumerate(histogram["buckets"]):
+            seen += count
+            if seen >= rank and count > 0:
+                return min(self.bucket_bounds[bucket], histogram["max"]) if bucket < len(self.bucket_bounds) else histogram["max"]
+        return histogram["max"]
+
+    def summary(self):
+        with self.lock:
+            histograms = {name: dict(histogram, buckets=list(histogram["buckets"])) for name, histogram in self.histograms.items()}
+
+        rows = []
+        for name in sorted(histograms):
+            histogram = histograms[name]
+            rows.append({
+                "name": name,
+                "count": histogram["count"],
+                "total": histogram["total"],
+                "mean": histogram["total"] / histogram["count"],
+                "p50": self.percentile(histogram, 50),
+                "p90": self.percentile(histogram, 90),
+                "p99": self.percentile(histogram, 99),
+                "max": histogram["max"],
+                "buckets": histogram["buckets"]
+            })
+        return rows
+
+    def dump(self, file_path):
+        # CSV with the summary of each operation, or JSON with the histograms too
+        rows = self.summary()
+        if file_path.endswith(".csv"):
+            with open(file_path, "w", encoding="UTF8", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(metrics_headers)
+                for row in rows:
+                    writer.writerow([row[name] for name in metrics_headers])
+        else:
+            with open(file_path, "w", encoding="UTF8") as f:
+                json.dump({"bucket_bounds": self.bucket_bounds, "operations": rows}, f, indent=2)
+
+class TimingSpan():
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.record(self.name, time.perf_counter() - self.start)
+
+def timed(name):
+    # Decorator timing every call of a function as the name span
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not metrics.enabled:
+                return function(*args, **kwargs)
+            with TimingSpan(metrics, name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+null_span = contextlib.nullcontext()
+metrics_headers = ["name", "count", "total", "mean", "p50", "p90", "p99", "max"]
+
+# Hot paths timing, enabled with VIDEO_LABELING_METRICS=1 or from the metrics panel
+metrics = Metrics(os.environ.get("VIDEO_LABELING_METRICS", "0") not in ("", "0"))
+
 class MainWindow(QMainWindow):
 
     def __init__(self):
         super(MainWindow, self).__init__()
 
-        # Tags Dataset
+        # Tags Dataset, restored from the autosave snapshot and journal of the user.
+        # They are locked by the first window, the other ones are not autosaved
         self.tags_dataset = TagDataset()
+        self.autosave_path = os.path.join(os.path.expanduser('~'), ".cache", "video_labeling", "autosave", "dataset.csv")
+        if not self.tags_dataset.openJournal(self.autosave_path):
+            showMessage("The autosave is used by another window, changes made here are not autosaved")
 
         # Default Tags
-        self.tags = [Tag()]
         self.labels_path = "labels.txt"
-        file = open(self.labels_path)
-        labels_lines = file.readlines()
-        for _, line in enumerate(labels_lines):
-            if len(line.split(',')) == 2:
-                label_id, label_name = line.rstrip().split(',')
-                tag = Tag(int(label_id), label_name)
-                self.tags.append(tag)
-        file.close()
+        self.tags = [Tag()] + loadLabels(self.labels_path)
 
         self.selected_tag = None
 
+        # Rows per chunk when loading datasets
+        self.load_chunk_size = 100000
+
+        # Processes used by the dataset export
+        self.export_workers = os.cpu_count() or 1
+
+        # Perceptual hash distance of pruned near-duplicate frames, None exports every frame.
+        # Pruned frames also need their bboxes to overlap by export_dedup_iou
+        self.export_dedup_distance = None
+        self.export_dedup_iou = 0.9
+
+        # Decoded frames cache size
+        self.frame_cache_size_mb = 512
+
+        # Save, load and export run as background jobs, the dataset is only
+        # used with this lock held while one of them is running
+        self.dataset_lock = threading.RLock()
+        self.job_pool = QThreadPool(self)
+        self.jobs = {}
+
         self.cap = None
+        self.frame_provider = None
+        self.video_indexer = None
+        self.video_index = None
+        self.thumbnail_generator = None
+        self.bbox_tracker = None
+        self.metrics_dialog = None
+        self.video_file_path = ""
+        self.video_paths = []
         self.curr_frame = 0
         self.total_frames = 0
 
         self.init_ui()
 
+        # Write a new autosave snapshot in background when there are changes
+        self.autosave_timer = QTimer(self)
+        self.autosave_timer.timeout.connect(self.onAutosaveTimeout)
+        self.autosave_timer.start(60 * 1000)
+
     def init_ui(self):
         self.setWindowTitle("Video Labeling App")
 
@@ -68,6 +236,10 @@ class MainWindow(QMainWindow):
         load_data_button_action.setStatusTip("Load Data Button")
         load_data_button_action.triggered.connect(self.onLoadDataButtonClick)
 
+        open_project_button_action = QAction(QIcon("database-export.png"), "&Open Project", self)
+        open_project_button_action.setStatusTip("Open or create a SQLite project")
+        open_project_button_action.triggered.connect(self.onOpenProjectButtonClick)
+
         add_label_button_action = QAction(QIcon("node-insert.png"), "&Add Label", self)
         add_label_button_action.setStatusTip("Add Label Button")
         add_label_button_action.triggered.connect(self.onAddItemButtonClick)
@@ -80,11 +252,32 @@ class MainWindow(QMainWindow):
         gen_yolo_data_button_action.setStatusTip("Generate Yolo Dataset")
         gen_yolo_data_button_action.triggered.connect(self.onGenYoloDataButtonClick)
 
+        interpolate_button_action = QAction("&Interpolate BBoxes", self)
+        interpolate_button_action.setStatusTip("Interpolate bboxes between a keyframe and the current frame")
+        interpolate_button_action.triggered.connect(self.onInterpolateButtonClick)
+
+        track_button_action = QAction("&Track BBoxes", self)
+        track_button_action.setStatusTip("Track the current frame bboxes over the next frames")
+        track_button_action.triggered.connect(self.onTrackButtonClick)
+
+        frame_cache_button_action = QAction("&Frame Cache Size", self)
+        frame_cache_button_action.setStatusTip("Set decoded frames cache size")
+        frame_cache_button_action.triggered.connect(self.onFrameCacheButtonClick)
+
+        dedup_button_action = QAction("&Frame Pruning", self)
+        dedup_button_action.setStatusTip("Set pruning of near-duplicate frames in the exported dataset")
+        dedup_button_action.triggered.connect(self.onDedupButtonClick)
+
+        metrics_button_action = QAction("&Metrics", self)
+        metrics_button_action.setStatusTip("Show the timing metrics panel")
+        metrics_button_action.triggered.connect(self.onMetricsButtonClick)
+
         menu = self.menuBar()
         file_menu = menu.addMenu("&File")
         file_menu.setCursor(Qt.PointingHandCursor)
         file_menu.addAction(load_video_button_action)
         file_menu.addAction(load_data_button_action)
+        file_menu.addAction(open_project_button_action)
 
         options_menu = menu.addMenu("&Options")
         options_menu.setCursor(Qt.PointingHandCursor)
@@ -92,25 +285,40 @@ class MainWindow(QMainWindow):
         options_menu.addAction(save_labels_button_action)
         options_menu.addAction(save_data_button_action)
         options_menu.addAction(gen_yolo_data_button_action)
+        options_menu.addAction(interpolate_button_action)
+        options_menu.addAction(track_button_action)
+        options_menu.addAction(frame_cache_button_action)
+        options_menu.addAction(dedup_button_action)
+        options_menu.addAction(metrics_button_action)
 
         main_hor_layout = QVBoxLayout()
 
+        # Project videos, the ones in the dataset and the opened ones
+        self.videos_combo_box = QComboBox()
+        self.videos_combo_box.setCursor(Qt.PointingHandCursor)
+        self.videos_combo_box.activated.connect(self.onVideosComboBoxActivated)
+
+        main_hor_layout.addWidget(self.videos_combo_box)
+
         img_ctl_ver_layout = QHBoxLayout()
         
         prev_btn = QPushButton("&Prev")
         prev_btn.setStatusTip("Previous Image Button")
         prev_btn.setCursor(Qt.PointingHandCursor)
+        prev_btn.setAutoRepeat(True)
         prev_btn.clicked.connect(self.onPrevButtonClick)
         
         next_btn = QPushButton("&Next")
         next_btn.setStatusTip("Next Image Button")
         next_btn.setCursor(Qt.PointingHandCursor)
+        next_btn.setAutoRepeat(True)
         next_btn.clicked.connect(self.onNextButtonClick)
         
         self.image_label = Label()
         self.image_label.setFixedSize(QSize(640, 480))
         self.image_label.setStyleSheet("border: 1px solid black;")
         self.image_label.rect_created.connect(self.onRect)
+        self.image_label.bbox_clicked.connect(self.onBBoxClicked)
 
         img_ctl_ver_layout.addWidget(prev_btn)
         img_ctl_ver_layout.addWidget(self.image_label)
@@ -118,6 +326,12 @@ class MainWindow(QMainWindow):
 
         main_hor_layout.addLayout(img_ctl_ver_layout)
 
+        self.frame_timeline = FrameTimeline()
+        self.frame_timeline.setCursor(Qt.PointingHandCursor)
+        self.frame_timeline.frame_clicked.connect(self.onTimelineFrameClicked)
+
+        main_hor_layout.addWidget(self.frame_timeline)
+
         self.frames_slider = QSlider()
         self.frames_slider.setOrientation(Qt.Horizontal)
         self.frames_slider.setSingleStep(1)
@@ -163,11 +377,22 @@ class MainWindow(QMainWindow):
             "Video Files (*.mp4 *.avi *.mpeg *.mov *.wmv *.flv *.mpg *.mkv)"
             )
 
-        # Initilize capture device
-        self.cap = cv.VideoCapture(self.video_file_path)
+        self.openVideo(self.video_file_path)
 
-        # Get total frames
-        self.total_frames = self.cap.get(cv.CAP_PROP_FRAME_COUNT)
+    def openVideo(self, video_file_path):
+        self.video_file_path = video_file_path
+
+        # Initilize capture device, the previous one goes back to the pool
+        if self.frame_provider is not None:
+            self.frame_provider.stop()
+        self.cap = capture_pool.acquire(self.video_file_path)
+        self.frame_provider = FrameProvider(self.cap, self.video_file_path, self.frame_cache_size_mb, preview_size=(self.image_label.width(), self.image_label.height()))
+        self.frame_provider.frame_ready.connect(self.onFrameReady)
+        self.frame_provider.frame_failed.connect(self.onFrameFailed)
+
+        # Get total frames, estimated until the video index is available
+        self.total_frames = int(self.cap.get(cv.CAP_PROP_FRAME_COUNT))
+        self.video_index = None
 
         # Initilize current frames
         self.curr_frame = 0
@@ -177,41 +402,206 @@ class MainWindow(QMainWindow):
             print("Opened with {} frames".format(self.total_frames))
 
             self.frames_slider.setMinimum(0)
-            self.frames_slider.setMaximum(self.total_frames)
+            self.frames_slider.setMaximum(max(self.total_frames - 1, 0))
             self.frames_slider.setValue(0)
 
+            self.loadVideoIndex(self.video_file_path)
+            self.loadThumbnails(self.video_file_path)
+
+            self.frame_timeline.setTotalFrames(self.total_frames)
+            self.refreshTimelineMarks()
+
+            if self.video_file_path not in self.video_paths:
+                self.video_paths.append(self.video_file_path)
+            self.refreshVideoList()
+
             self.moveToCurrFrame()
         else:
             print("Cannot open {}".format(self.video_file_path))
 
+    def refreshVideoList(self):
+        with self.dataset_lock:
+            file_names = list(self.tags_dataset.file_indexes)
+
+        for file_name in file_names:
+            if file_name not in self.video_paths and os.path.isfile(file_name):
+                self.video_paths.append(file_name)
+
+        self.videos_combo_box.blockSignals(True)
+        self.videos_combo_box.clear()
+        for video_file_path in self.video_paths:
+            self.videos_combo_box.addItem(os.path.basename(video_file_path), video_file_path)
+        self.videos_combo_box.setCurrentIndex(self.videos_combo_box.findData(self.video_file_path))
+        self.videos_combo_box.blockSignals(False)
+
+        # Open the videos next to the current one, so switching to them is instant
+        index = self.video_paths.index(self.video_file_path) if self.video_file_path in self.video_paths else 0
+        capture_pool.prefetch([path for path in self.video_paths[max(index - 1, 0):index + 2] if path != self.video_file_path])
+
+    def onVideosComboBoxActivated(self, index):
+        video_file_path = self.videos_combo_box.itemData(index)
+        if video_file_path is not None and video_file_path != self.video_file_path:
+            self.openVideo(video_file_path)
+
+    def loadVideoIndex(self, video_file_path):
+        video_index = VideoIndex.load(video_file_path)
+        if video_index is not None:
+            self.onVideoIndexReady(video_file_path, video_index)
+            return
+
+        # Scan the video once in background
+        if self.video_indexer is not None:
+            self.video_indexer.stop()
+        self.video_indexer = VideoIndexer(video_file_path)
+        self.video_indexer.index_ready.connect(self.onVideoIndexReady)
+        self.video_indexer.start()
+
+    def onVideoIndexReady(self, video_file_path, video_index):
+        if video_file_path != self.video_file_path or self.frame_provider is None:
+            return
+
+        print("Indexed {} frames, {} keyframes".format(video_index.frame_count, len(video_index.keyframes) if video_index.has_keyframes else "unknown"))
+
+        self.video_index = video_index
+        self.frame_provider.setIndex(video_index)
+
+        self.total_frames = video_index.frame_count
+        self.frames_slider.setMaximum(max(self.total_frames - 1, 0))
+        self.frame_timeline.setTotalFrames(self.total_frames)
+
+    def loadThumbnails(self, video_file_path):
+        if self.thumbnail_generator is not None:
+            self.thumbnail_generator.stop()
+            self.thumbnail_generator = None
+
+        thumbnails = VideoThumbnails.load(video_file_path)
+        self.frame_timeline.setThumbnails(thumbnails)
+        if thumbnails is not None:
+            return
+
+        # Generate them once in background, the strip fills in as they come
+        self.thumbnail_generator = ThumbnailGenerator(video_file_path)
+        self.thumbnail_generator.thumbnails_ready.connect(self.onThumbnailsReady)
+        self.thumbnail_generator.start()
+
+    def onThumbnailsReady(self, video_file_path, thumbnails):
+        if video_file_path == self.video_file_path:
+            self.frame_timeline.setThumbnails(thumbnails)
+
+    def onTimelineFrameClicked(self, frame_id):
+        self.curr_frame = frame_id
+
+        self.moveToCurrFrame()
+
     def onLoadDataButtonClick(self, s):
         print("Load Data Button Click")
         
         self.data_file_path, _ = QFileDialog.getOpenFileName(
             self,
-            "Open CSV Data File", 
+            "Open Data File", 
             os.path.expanduser('~'), 
-            "Data Files (*.csv)"
+            "Data Files (*.csv *.vlb)"
             )
         
-        if self.data_file_path != "":
-            self.tags_dataset.loadDataset(self.data_file_path)
+        if self.data_file_path != "" and "Load data" in self.jobs:
+            showMessage("Load data is already running")
+        elif self.data_file_path != "" and self.confirmLoadDataset():
+            tags_dataset = self.tags_dataset
+            data_file_path = self.data_file_path
+            chunk_size = self.load_chunk_size
+
+            # Frames can be browsed while it loads, the chunks show up as they come
+            self.startJob("Load data", lambda job: tags_dataset.loadDataset(data_file_path, chunk_size, job.setProgress, lock=self.dataset_lock), self.onDatasetLoaded)
+
+    def confirmLoadDataset(self):
+        # Loaded data is added to the bboxes already there, as the ones
+        # restored from the autosave, loading the same file again doubles them
+        if len(self.tags_dataset) == 0:
+            return True
+
+        msgBox = QMessageBox()
+        msgBox.setText("The dataset already has {} bboxes".format(len(self.tags_dataset)))
+        msgBox.setInformativeText("Replace them with the loaded data or merge it with them?")
+        replace_button = msgBox.addButton("Replace", QMessageBox.DestructiveRole)
+        merge_button = msgBox.addButton("Merge", QMessageBox.AcceptRole)
+        msgBox.addButton(QMessageBox.Cancel)
+        msgBox.exec_()
+
+        if msgBox.clickedButton() == replace_button:
+            with self.dataset_lock:
+                self.tags_dataset.clear()
+            self.selected_tag = None
+            return True
+
+        return msgBox.clickedButton() == merge_button
+
+    def onDatasetLoaded(self, job, state):
+        # Canceled loads keep the chunks already added
+        self.refreshTimelineMarks()
+        self.refreshVideoList()
+        self.moveToCurrFrame()
     
+    def onOpenProjectButtonClick(self, s):
+        print("Open Project Button Click")
+
+        db_path, _ = QFileDialog.getSaveFileName(
+            self,
+            "Open or Create Project",
+            os.getcwd() + "/bbox_dataset.db",
+            "Project Files (*.db *.sqlite)",
+            options=QFileDialog.DontConfirmOverwrite
+            )
+
+        if db_path != "" and len(self.jobs) > 0:
+            showMessage("Wait for {} to finish".format(", ".join(self.jobs)))
+        elif db_path != "":
+            self.closeDataset()
+            self.tags_dataset = SQLiteTagDataset(db_path)
+            print("Opened project {} with {} bboxes".format(db_path, len(self.tags_dataset)))
+
+            self.refreshTimelineMarks()
+            self.refreshVideoList()
+            self.moveToCurrFrame()
+
     def onSaveButtonClick(self, s):
         print("Save Button Clicked ")
 
         save_path, _ = QFileDialog.getSaveFileName(
             self,
-            "Save CSV Data File", 
+            "Save Data File", 
             os.getcwd() + "/bbox_dataset.csv", 
-            "Data Files (*.csv)"
+            "Data Files (*.csv);;Binary Data Files (*.vlb)"
             )
 
         if save_path != '':
-            self.tags_dataset.saveDataset(save_path)
+            tags_dataset = self.tags_dataset
+            self.startJob("Save data", lambda job: tags_dataset.saveDataset(save_path, lock=self.dataset_lock, progress_callback=job.setProgress))
+
+    def startJob(self, name, function, on_done=None):
+        if name in self.jobs:
+            showMessage("{} is already running".format(name))
+            return None
+
+        job = BackgroundJob(name, function)
+
+        def onJobDone(job, state):
+            del self.jobs[job.name]
+            self.statusBar().removeWidget(progress_widget)
+            progress_widget.deleteLater()
+
+            if on_done is not None:
+                on_done(job, state)
+
+        progress_widget = JobProgressWidget(job, onJobDone)
+        self.statusBar().addPermanentWidget(progress_widget)
+        self.statusBar().show()
+
+        self.jobs[name] = job
+        self.job_pool.start(job)
+        return job
 
     def onNextButtonClick(self, s):
-        if self.curr_frame < self.total_frames:
+        if self.curr_frame < self.total_frames - 1:
             self.curr_frame += 1
         else:
             self.curr_frame = 0
@@ -222,10 +612,11 @@ class MainWindow(QMainWindow):
         if self.curr_frame > 0:
             self.curr_frame -= 1
         else:
-            self.curr_frame = self.total_frames
+            self.curr_frame = max(self.total_frames - 1, 0)
 
         self.moveToCurrFrame()
         
+    @timed("ui.move_to_frame")
     def moveToCurrFrame(self):
     
         if self.cap is None:
@@ -233,68 +624,118 @@ class MainWindow(QMainWindow):
 
         print("Move to Frame: ", self.curr_frame)
 
-        # Set frame position
-        self.cap.set(cv.CAP_PROP_POS_FRAMES, self.curr_frame)
-
-        # Get image
-        retval, image = self.cap.read()
+        # Get image, it is shown from onFrameReady when it is not decoded yet
+        preview_frame = self.frame_provider.requestFrame(self.curr_frame)
 
-        if retval:
+        if preview_frame is not None:
     
-            # Set image label
-            self.curr_image = QImage(image.data, image.shape[1], image.shape[0], QImage.Format_RGB888).rgbSwapped()
-            pixmap_img = QPixmap.fromImage(self.curr_image)
+            # Set image label, bboxes are in the native frame pixels
+            self.curr_frame_image = preview_frame
+            self.image_label.setFrame(preview_frame.toQImage(), QSize(preview_frame.width, preview_frame.height))
+
+            self.refreshBBoxes()
+
+            self.frames_slider.setValue(self.curr_frame)
+            
+        else:
+            self.frames_slider.setValue(self.curr_frame)
 
-            # Find bboxes in this image label to draw it
+        self.frame_timeline.setCurrentFrame(self.curr_frame)
+
+    def refreshBBoxes(self):
+        # Find bboxes in this image label to draw it
+        with self.dataset_lock:
             bbox_tags = self.tags_dataset.getFrameBBoxs(self.video_file_path, self.curr_frame)
 
-            painter = QPainter(pixmap_img)
+        self.list_widget.clear()
+        for bbox_tag in bbox_tags:
+            self.list_widget.addItem(createBBoxListItem(bbox_tag))
+
+        self.image_label.setBBoxes(bbox_tags)
+        self.frame_timeline.setFrameAnnotated(self.curr_frame, len(bbox_tags) > 0)
 
-            self.list_widget.clear()
-            for bbox_tag in bbox_tags:
-                drawBBoxLabel(painter, bbox_tag.rect, bbox_tag.tag.name)
-                self.list_widget.addItem(getBBoxLabelName(bbox_tag.rect, bbox_tag.tag.name))
+        self.selected_tag = None
+        self.delete_btn.setEnabled(False)
 
-            painter.end()
+    def refreshTimelineMarks(self):
+        if self.cap is not None:
+            with self.dataset_lock:
+                frame_ids = self.tags_dataset.getFrameIds(self.video_file_path)
+            self.frame_timeline.setAnnotatedFrames(frame_ids)
 
-            self.image_label.setPixmap(pixmap_img)
+    def onFrameReady(self, frame_id):
+        if frame_id == int(self.curr_frame):
+            self.moveToCurrFrame()
 
-            self.frames_slider.setValue(self.curr_frame)
+    def onFrameFailed(self, frame_id):
+        if frame_id == int(self.curr_frame):
+            showMessage("Cannot retrieve frame at {}".format(frame_id))
+
+    def onAutosaveTimeout(self):
+        journal = self.tags_dataset.journal
+        if journal is not None and journal.changes_count > 0:
+            with self.dataset_lock:
+                journal.snapshot(self.tags_dataset)
+
+    def closeDataset(self):
+        journal = self.tags_dataset.journal
+        if journal is not None:
+            if journal.changes_count > 0:
+                with self.dataset_lock:
+                    journal.snapshot(self.tags_dataset, wait=True)
+            journal.close()
+            self.tags_dataset.journal = None
+
+        if isinstance(self.tags_dataset, SQLiteTagDataset):
+            self.tags_dataset.close()
+
+    def closeEvent(self, event):
+        self.autosave_timer.stop()
+
+        # Loads and exports stop at their next step and are left unfinished,
+        # saves were asked for and are waited for
+        for job in self.jobs.values():
+            if job.name in ("Save data", "Save labels"):
+                print("Waiting for {} to finish".format(job.name))
+            else:
+                job.cancel()
+        self.job_pool.waitForDone()
 
-            self.selected_tag = None
-            
-        else:
-            showMessage("Cannot retrieve frame at {}".format(self.curr_frame))
+        self.closeDataset()
 
-    def onRect(self, r):
-        
-        bbox_tag = BBoxTag()
-        tag = self.tags[self.tags_combo_box.currentIndex()]
-        bbox_tag.setValues(r, tag, self.curr_frame, self.video_file_path)
+        if self.video_indexer is not None:
+            self.video_indexer.stop()
+            self.video_indexer = None
 
-        if self.selected_tag is None:            
-            self.tags_dataset.addTag(bbox_tag)
-        else:
-            self.tags_dataset.updateBBoxTag(self.selected_tag, bbox_tag)
+        if self.thumbnail_generator is not None:
+            self.thumbnail_generator.stop()
+            self.thumbnail_generator = None
 
-        pixmap_img = QPixmap.fromImage(self.curr_image)
+        if self.bbox_tracker is not None:
+            self.bbox_tracker.stop()
+            self.bbox_tracker = None
 
-        # Find bboxes in this image label to draw it
-        bbox_tags = self.tags_dataset.getFrameBBoxs(self.video_file_path, self.curr_frame)
+        if self.frame_provider is not None:
+            self.frame_provider.stop()
+            self.frame_provider = None
 
-        painter = QPainter(pixmap_img)
+        capture_pool.clear()
 
-        self.list_widget.clear()
-        for bbox_tag in bbox_tags:
-            drawBBoxLabel(painter, bbox_tag.rect, bbox_tag.tag.name)
-            self.list_widget.addItem(getBBoxLabelName(bbox_tag.rect, bbox_tag.tag.name))
+        super(MainWindow, self).closeEvent(event)
 
-        painter.end()
+    def onRect(self, r):
+        
+        bbox_tag = BBoxTag()
+        tag = self.tags[self.tags_combo_box.currentIndex()]
+        bbox_tag.setValues(r, tag, self.curr_frame, self.video_file_path)
 
-        self.image_label.setPixmap(pixmap_img)
-        self.image_label.update()
+        with self.dataset_lock:
+            if self.selected_tag is None:
+                self.tags_dataset.addTag(bbox_tag)
+            else:
+                self.tags_dataset.updateBBoxTag(self.selected_tag, bbox_tag)
 
-        self.selected_tag = None
+        self.refreshBBoxes()
 
     def onAddItemButtonClick(self):
         text, ok = QInputDialog().getText(self, "Add new item label",
@@ -305,6 +746,36 @@ class MainWindow(QMainWindow):
             self.tags.append(new_tag)
             self.tags_combo_box.addItem(new_tag.name)
 
+    def onFrameCacheButtonClick(self):
+        size_mb, ok = QInputDialog().getInt(self, "Frame cache size",
+                                     "Size (MB):", self.frame_cache_size_mb, 0, 65536)
+        if ok:
+            self.frame_cache_size_mb = size_mb
+            if self.frame_provider is not None:
+                self.frame_provider.setCacheSize(size_mb)
+
+    def onDedupButtonClick(self):
+        distance = self.export_dedup_distance if self.export_dedup_distance is not None else -1
+        distance, ok = QInputDialog().getInt(self, "Frame pruning",
+                                     "Max hash distance (bits, -1 exports every frame):", distance, -1, 64)
+        if not ok:
+            return
+
+        if distance < 0:
+            self.export_dedup_distance = None
+            return
+
+        iou, ok = QInputDialog().getDouble(self, "Frame pruning",
+                                     "Min bboxes IoU:", self.export_dedup_iou, 0.0, 1.0, 2)
+        if ok:
+            self.export_dedup_distance = distance
+            self.export_dedup_iou = iou
+
+    def onMetricsButtonClick(self):
+        if self.metrics_dialog is None:
+            self.metrics_dialog = MetricsDialog(self)
+        self.metrics_dialog.show()
+
     def sliderReleased(self):
         print("Slider Released at {}".format(self.frames_slider.value()))
 
@@ -314,243 +785,2209 @@ class MainWindow(QMainWindow):
 
     def onListWidgetItemClicked(self, item):
         
-        # Parse item string
-        label_dict = parseBBoxLabelName(item.text())
-        
-        # Get item rect
-        target_rect = QRect(int(label_dict['x']), int(label_dict['y']), int(label_dict['w']), int(label_dict['h']))
-        
-        # Get item tag name
-        target_name = label_dict["name"]
-
-        # Find bboxes in this image label to draw it
-        bbox_tags = self.tags_dataset.getFrameBBoxs(self.video_file_path, self.curr_frame)
-
-        image_label_pixmap= self.image_label.pixmap()
-        painter = QPainter(image_label_pixmap)
-
-        for bbox_tag in bbox_tags:
-            if bbox_tag.tag.name.replace(" ", "") == target_name and bbox_tag.rect == target_rect: 
-                drawBBoxLabel(painter, bbox_tag.rect, bbox_tag.tag.name, color=Qt.green)
-                self.selected_tag = bbox_tag
-                self.delete_btn.setEnabled(True) 
-            else:
-                drawBBoxLabel(painter, bbox_tag.rect, bbox_tag.tag.name)
-
-        painter.end()
+        # Get item bbox id
+        target_id = item.data(Qt.UserRole)
+
+        with self.dataset_lock:
+            self.selected_tag = self.tags_dataset.getBBoxTag(target_id)
+        if self.selected_tag is not None:
+            self.delete_btn.setEnabled(True)
+            self.image_label.setSelected(target_id)
+
+    def onBBoxClicked(self, bbox_id):
+        if bbox_id is None:
+            self.onListWidgetItemDoubleClicked(None)
+            return
 
-        self.image_label.setPixmap(image_label_pixmap)
-        self.image_label.update()
+        for row in range(self.list_widget.count()):
+            item = self.list_widget.item(row)
+            if item.data(Qt.UserRole) == bbox_id:
+                self.list_widget.setCurrentItem(item)
+                self.onListWidgetItemClicked(item)
+                break
 
     def onListWidgetItemDoubleClicked(self, item):
         self.list_widget.clearSelection()
         self.selected_tag = None
         self.delete_btn.setEnabled(False)
 
-        pixmap_img = QPixmap.fromImage(self.curr_image)
-        
-        bbox_tags = self.tags_dataset.getFrameBBoxs(self.video_file_path, self.curr_frame)
-
-        painter = QPainter(pixmap_img)
-        for bbox_tag in bbox_tags:
-            drawBBoxLabel(painter, bbox_tag.rect, bbox_tag.tag.name)
-        painter.end()
-        
-        self.image_label.setPixmap(pixmap_img)
-        self.image_label.update()
+        self.image_label.setSelected(None)
 
     def onDeleteBtnClicked(self):
         print("Delete Button Clicked")
 
         # Find selected tag in database
         # Delete from database
-        self.tags_dataset.deleteBBoxTag(self.selected_tag)
+        with self.dataset_lock:
+            self.tags_dataset.deleteBBoxTag(self.selected_tag)
 
         # Repaint labels
-        # Find bboxes in this image label to draw it
-        bbox_tags = self.tags_dataset.getFrameBBoxs(self.video_file_path, self.curr_frame)
+        self.refreshBBoxes()
 
-        pixmap_img = QPixmap.fromImage(self.curr_image)
-        
-        painter = QPainter(pixmap_img)
-        self.list_widget.clear()
-        for bbox_tag in bbox_tags:
-            drawBBoxLabel(painter, bbox_tag.rect, bbox_tag.tag.name)
-            self.list_widget.addItem(getBBoxLabelName(bbox_tag.rect, bbox_tag.tag.name))
-        painter.end()
-        
-        self.image_label.setPixmap(pixmap_img)
-        self.image_label.update()    
+    def onInterpolateButtonClick(self):
+        if self.cap is None:
+            return
+
+        # Previous annotated frame by default
+        with self.dataset_lock:
+            frame_ids = self.tags_dataset.getFrameIds(self.video_file_path)
+        prev_frame_ids = frame_ids[frame_ids < self.curr_frame]
+        default_frame = int(prev_frame_ids[-1]) if len(prev_frame_ids) > 0 else 0
+
+        keyframe, ok = QInputDialog().getInt(self, "Interpolate BBoxes",
+                                     "From keyframe:", default_frame, 0, max(self.total_frames - 1, 0))
+        if not ok or keyframe == self.curr_frame:
+            return
+
+        with self.dataset_lock:
+            bboxes_a = self.tags_dataset.getFrameBBoxs(self.video_file_path, keyframe)
+            bboxes_b = self.tags_dataset.getFrameBBoxs(self.video_file_path, self.curr_frame)
+        if len(bboxes_a) == 0 or len(bboxes_b) == 0:
+            showMessage("Both keyframes need bboxes to interpolate")
+            return
+
+        self.addPropagatedBBoxes(interpolateBBoxes(bboxes_a, keyframe, bboxes_b, self.curr_frame))
+
+    def onTrackButtonClick(self):
+        if self.cap is None or self.bbox_tracker is not None:
+            return
+
+        with self.dataset_lock:
+            bbox_tags = self.tags_dataset.getFrameBBoxs(self.video_file_path, self.curr_frame)
+        if len(bbox_tags) == 0:
+            showMessage("Draw the bboxes to track first")
+            return
+
+        if createBBoxTracker() is None:
+            showMessage("No OpenCV tracker available")
+            return
+
+        frames_count, ok = QInputDialog().getInt(self, "Track BBoxes",
+                                     "Frames to track:", 100, 1, max(self.total_frames - self.curr_frame - 1, 1))
+        if not ok:
+            return
+
+        self.tracking_progress = QProgressDialog("Tracking bboxes", "Cancel", 0, frames_count, self)
+        self.tracking_progress.setMinimumDuration(500)
+
+        # Tracking runs on its own capture, frames can be browsed meanwhile
+        self.bbox_tracker = BBoxTracker(self.video_file_path, self.video_index, self.curr_frame, bbox_tags, frames_count)
+        self.bbox_tracker.tracking_progress.connect(self.tracking_progress.setValue)
+        self.bbox_tracker.tracking_done.connect(self.onTrackingDone)
+        self.tracking_progress.canceled.connect(self.bbox_tracker.stop)
+        self.bbox_tracker.start()
+
+    def onTrackingDone(self, video_file_path, columns):
+        # Canceled trackings keep the frames tracked so far
+        self.bbox_tracker.wait()
+        self.bbox_tracker = None
+        self.tracking_progress.reset()
+
+        if video_file_path == self.video_file_path:
+            self.addPropagatedBBoxes(columns)
+
+    def addPropagatedBBoxes(self, columns):
+        with self.dataset_lock:
+            # Frames that already have bboxes are left as they are
+            mask = ~np.isin(columns["frame_id"], self.tags_dataset.getFrameIds(self.video_file_path))
+            count = int(np.count_nonzero(mask))
+
+            if count > 0:
+                self.tags_dataset.appendColumns(
+                    columns["x"][mask], columns["y"][mask], columns["w"][mask], columns["h"][mask],
+                    columns["tag_id"][mask], columns["tag_name"][mask], columns["frame_id"][mask],
+                    np.full(count, self.video_file_path, dtype=object))
+
+                # Batches are not journaled, they go straight to a snapshot
+                if self.tags_dataset.journal is not None:
+                    self.tags_dataset.journal.recordBulkChange(self.tags_dataset)
+
+        print("Added {} propagated bboxes".format(count))
+
+        self.refreshTimelineMarks()
+        self.moveToCurrFrame()
 
     def onSaveLabelsButtonClick(self):
-        self.saveLabels()
+        labels_path = self.labels_path
+        tags = list(self.tags)
+        self.startJob("Save labels", lambda job: writeLabels(labels_path, tags), self.onLabelsSaved)
+
+    def onLabelsSaved(self, job, state):
+        if state == "finished":
+            showMessage("Labels saved to {}".format(self.labels_path))
+
+    def onGenYoloDataButtonClick(self):
+        print("Generate Yolo Dataset")
+
+        exporter = YoloExporter(".", "minesign_dataset", workers=self.export_workers, sink="zip", dedup_distance=self.export_dedup_distance, dedup_iou=self.export_dedup_iou)
+        tags_dataset = self.tags_dataset
+
+        def onExportDone(job, state):
+            if state != "finished":
+                return
+
+            exported_count, unchanged_count, pruned_count, removed_count = job.result
+            message = "Exported {} frames, {} unchanged to {}".format(exported_count, unchanged_count, exporter.outputPath())
+            if pruned_count > 0:
+                message += "\n{} near-duplicate frames pruned, listed in {} of {}".format(pruned_count, exporter.prunedReportPath(), exporter.outputPath())
+            showMessage(message)
+
+        # The dataset lock is only held while the bboxes are read
+        self.startJob("Export", lambda job: exporter.export(tags_dataset, self.dataset_lock, job.setProgress), onExportDone)
+
+    def saveLabels(self):
+
+        try:
+            writeLabels(self.labels_path, self.tags)
+            showMessage("Labels saved to {}".format(self.labels_path))
+        except OSError:
+            showMessage("Something went wrong when writing to file {}".format(self.labels_path))
+
+class MetricsDialog(QDialog):
+
+    def __init__(self, parent=None):
+        super(MetricsDialog, self).__init__(parent)
+        self.setWindowTitle("Metrics")
+        self.resize(760, 400)
+
+        self.enabled_check_box = QCheckBox("Enabled")
+        self.enabled_check_box.setChecked(metrics.enabled)
+        self.enabled_check_box.toggled.connect(self.onEnabledToggled)
+
+        reset_btn = QPushButton("Reset")
+        reset_btn.clicked.connect(self.onResetButtonClick)
+
+        dump_btn = QPushButton("Dump")
+        dump_btn.clicked.connect(self.onDumpButtonClick)
+
+        # Times are shown in ms
+        self.table = QTableWidget(0, len(metrics_headers))
+        self.table.setHorizontalHeaderLabels([name if name in ("name", "count") else name + " (ms)" for name in metrics_headers])
+
+        buttons_layout = QHBoxLayout()
+        buttons_layout.addWidget(self.enabled_check_box)
+        buttons_layout.addWidget(reset_btn)
+        buttons_layout.addWidget(dump_btn)
+
+        layout = QVBoxLayout()
+        layout.addLayout(buttons_layout)
+        layout.addWidget(self.table)
+        self.setLayout(layout)
+
+        # Refreshed while the dialog is shown
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.timeout.connect(self.refresh)
+
+    def showEvent(self, event):
+        self.refresh()
+        self.refresh_timer.start(1000)
+        super(MetricsDialog, self).showEvent(event)
+
+    def hideEvent(self, event):
+        self.refresh_timer.stop()
+        super(MetricsDialog, self).hideEvent(event)
+
+    def refresh(self):
+        rows = metrics.summary()
+        self.table.setRowCount(len(rows))
+        for i, row in enumerate(rows):
+            for j, name in enumerate(metrics_headers):
+                if name == "name":
+                    text = row[name]
+                elif name == "count":
+                    text = str(row[name])
+                else:
+                    text = "{:.3f}".format(row[name] * 1000)
+                self.table.setItem(i, j, QTableWidgetItem(text))
+
+    def onEnabledToggled(self, checked):
+        metrics.enabled = checked
+
+    def onResetButtonClick(self):
+        metrics.reset()
+        self.refresh()
+
+    def onDumpButtonClick(self):
+        dump_path, _ = QFileDialog.getSaveFileName(
+            self,
+            "Dump Metrics",
+            os.getcwd() + "/metrics.json",
+            "JSON Files (*.json);;CSV Files (*.csv)"
+            )
+
+        if dump_path != "":
+            metrics.dump(dump_path)
+
+class JobCancelled(Exception):
+    pass
+
+class JobSignals(QObject):
+
+    # Progress in per mille, then one of finished, failed or cancelled
+    progress = Signal(int)
+    finished = Signal(object)
+    failed = Signal(str)
+    cancelled = Signal()
+
+class BackgroundJob(QRunnable):
+
+    # Runs function(job) on a QThreadPool thread. The function reports its
+    # progress with job.setProgress(done, total), which raises JobCancelled
+    # once the job is cancelled so it stops at the next step
+
+    def __init__(self, name, function):
+        super(BackgroundJob, self).__init__()
+        self.setAutoDelete(False)
+
+        self.name = name
+        self.function = function
+        self.signals = JobSignals()
+        self.cancel_event = threading.Event()
+        # Return value of function once the job finished
+        self.result = None
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def setProgress(self, done, total):
+        if self.cancel_event.is_set():
+            raise JobCancelled()
+        self.signals.progress.emit(int(1000 * done / max(total, 1)))
+
+    def run(self):
+        try:
+            result = self.function(self)
+        except JobCancelled:
+            self.signals.cancelled.emit()
+        except Exception as error:
+            print("{} failed: {!r}".format(self.name, error))
+            self.signals.failed.emit(str(error))
+        else:
+            self.signals.finished.emit(result)
+
+class JobProgressWidget(QWidget):
+
+    # Status bar entry of a running job, on_done(job, state) is called from
+    # the GUI thread once it ends with state "finished", "failed" or "cancelled"
+
+    def __init__(self, job, on_done):
+        super(JobProgressWidget, self).__init__()
+        self.job = job
+        self.on_done = on_done
+
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, 1000)
+        self.progress_bar.setMaximumWidth(160)
+
+        self.cancel_btn = QPushButton("Cancel")
+        self.cancel_btn.setCursor(Qt.PointingHandCursor)
+        self.cancel_btn.clicked.connect(self.onCancelButtonClick)
+
+        layout = QHBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(QLabel(job.name))
+        layout.addWidget(self.progress_bar)
+        layout.addWidget(self.cancel_btn)
+        self.setLayout(layout)
+
+        # Slots of this widget run in the GUI thread
+        job.signals.progress.connect(self.progress_bar.setValue)
+        job.signals.finished.connect(self.onFinished)
+        job.signals.failed.connect(self.onFailed)
+        job.signals.cancelled.connect(self.onCancelled)
+
+    def onCancelButtonClick(self):
+        self.cancel_btn.setEnabled(False)
+        self.job.cancel()
+
+    def onFinished(self, result):
+        self.job.result = result
+        self.on_done(self.job, "finished")
+
+    def onFailed(self, message):
+        showMessage("{} failed: {}".format(self.job.name, message))
+        self.on_done(self.job, "failed")
+
+    def onCancelled(self):
+        print("{} cancelled".format(self.job.name))
+        self.on_done(self.job, "cancelled")
+
+class CapturePool():
+
+    # Open captures kept by video path, a capture is used by one owner at a
+    # time: acquire takes it out of the pool and release puts it back so the
+    # next acquire of the same video skips the container open and probe
+
+    def __init__(self, max_size=4):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.idle = OrderedDict()
+        self.idle_count = 0
+
+    def acquire(self, video_file_path):
+        with self.lock:
+            caps = self.idle.get(video_file_path)
+            if caps:
+                self.idle_count -= 1
+                cap = caps.pop()
+                if len(caps) == 0:
+                    del self.idle[video_file_path]
+                return cap
+
+        return cv.VideoCapture(video_file_path)
+
+    def release(self, video_file_path, cap):
+        # Returns cap to the pool, closing the least recently used ones over max_size
+        if not cap.isOpened():
+            cap.release()
+            return
+
+        with self.lock:
+            self.idle.setdefault(video_file_path, []).append(cap)
+            self.idle.move_to_end(video_file_path)
+            self.idle_count += 1
+
+        self.clear(keep=self.max_size)
+
+    def prefetch(self, video_file_paths):
+        # Opens the videos without an idle capture in background
+        def openCaptures():
+            for video_file_path in video_file_paths:
+                with self.lock:
+                    if video_file_path in self.idle:
+                        continue
+                self.release(video_file_path, cv.VideoCapture(video_file_path))
+
+        threading.Thread(target=openCaptures, daemon=True).start()
+
+    def clear(self, keep=0):
+        # Closes the least recently used idle captures over keep
+        evicted = []
+        with self.lock:
+            while self.idle_count > keep:
+                old_path, caps = next(iter(self.idle.items()))
+                evicted.append(caps.pop(0))
+                if len(caps) == 0:
+                    del self.idle[old_path]
+                self.idle_count -= 1
+
+        for old_cap in evicted:
+            old_cap.release()
+
+# Captures shared by the viewer, the exporter and the background workers
+capture_pool = CapturePool()
+
+class VideoIndex():
+
+    def __init__(self, frame_count=0, timestamps=None, keyframes=None, has_keyframes=False):
+        self.frame_count = frame_count
+        self.timestamps = timestamps if timestamps is not None else np.zeros(0, dtype=np.float64)
+        self.keyframes = keyframes if keyframes is not None else np.zeros(1, dtype=np.int64)
+
+        # False when the backend could not tell keyframes apart, keyframes is
+        # then only the first frame and seeks go through the backend
+        self.has_keyframes = has_keyframes
+
+    @staticmethod
+    def cacheDir():
+        return os.path.join(os.path.expanduser('~'), ".cache", "video_labeling", "index")
+
+    @staticmethod
+    def cacheKey(video_file_path):
+        # Hash of the file size, mtime and its first and last MB
+        stat = os.stat(video_file_path)
+        hasher = hashlib.sha1("{}:{}".format(stat.st_size, stat.st_mtime_ns).encode())
+        with open(video_file_path, "rb") as f:
+            hasher.update(f.read(1 << 20))
+            if stat.st_size > 2 << 20:
+                f.seek(-(1 << 20), os.SEEK_END)
+                hasher.update(f.read(1 << 20))
+        return hasher.hexdigest()
+
+    @classmethod
+    def cachePath(cls, video_file_path):
+        return os.path.join(cls.cacheDir(), cls.cacheKey(video_file_path) + ".npz")
+
+    @classmethod
+    def load(cls, video_file_path):
+        try:
+            with np.load(cls.cachePath(video_file_path)) as data:
+                # Older indexes without the flag only know keyframes when they found some
+                has_keyframes = bool(data["has_keyframes"]) if "has_keyframes" in data.files else len(data["keyframes"]) > 1
+                return cls(int(data["frame_count"]), data["timestamps"], data["keyframes"], has_keyframes)
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def save(self, video_file_path):
+        os.makedirs(self.cacheDir(), exist_ok=True)
+        cache_path = self.cachePath(video_file_path)
+        tmp_path = cache_path + ".tmp.npz"
+        np.savez(tmp_path, frame_count=self.frame_count, timestamps=self.timestamps, keyframes=self.keyframes, has_keyframes=self.has_keyframes)
+        os.replace(tmp_path, cache_path)
+
+    @classmethod
+    def scan(cls, video_file_path, should_stop=None):
+        # Not pooled, the capture is switched to raw packets
+        cap = cv.VideoCapture(video_file_path)
+        if not cap.isOpened():
+            return None
+
+        # Read packets without decoding when the backend supports it
+        raw_packets = cap.set(cv.CAP_PROP_FORMAT, -1)
+
+        timestamps = []
+        keyframes = []
+        while cap.grab():
+            if should_stop is not None and should_stop():
+                cap.release()
+                return None
+
+            if raw_packets and cap.get(cv.CAP_PROP_LRF_HAS_KEY_FRAME):
+                keyframes.append(len(timestamps))
+            timestamps.append(cap.get(cv.CAP_PROP_POS_MSEC))
+
+        cap.release()
+
+        # Without keyframes info only the first frame is a safe seek point
+        if len(keyframes) == 0 or keyframes[0] != 0:
+            keyframes.insert(0, 0)
+
+        return cls(len(timestamps), np.array(timestamps, dtype=np.float64), np.array(keyframes, dtype=np.int64), bool(raw_packets))
+
+    def nearestKeyframe(self, frame_id):
+        i = np.searchsorted(self.keyframes, frame_id, side="right") - 1
+        return int(self.keyframes[max(i, 0)])
+
+class VideoIndexer(QThread):
+
+    index_ready = Signal(str, object)
+
+    def __init__(self, video_file_path):
+        super(VideoIndexer, self).__init__()
+        self.video_file_path = video_file_path
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+        self.wait()
+
+    def run(self):
+        video_index = VideoIndex.scan(self.video_file_path, lambda: self.stopped)
+        if video_index is None:
+            return
+
+        try:
+            video_index.save(self.video_file_path)
+        except OSError as error:
+            print(error)
+
+        self.index_ready.emit(self.video_file_path, video_index)
+
+class VideoThumbnails():
+
+    # Thumbnails height in pixels and most thumbnails kept per video
+    height = 48
+    max_count = 2000
+
+    def __init__(self, interval=1, frame_ids=None, images=None):
+        self.interval = interval
+        self.frame_ids = frame_ids if frame_ids is not None else np.zeros(0, dtype=np.int64)
+        self.images = images if images is not None else np.zeros((0, self.height, self.height, 3), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.frame_ids)
+
+    @staticmethod
+    def cacheDir():
+        return os.path.join(os.path.expanduser('~'), ".cache", "video_labeling", "thumbnails")
+
+    @classmethod
+    def cachePath(cls, video_file_path):
+        return os.path.join(cls.cacheDir(), VideoIndex.cacheKey(video_file_path) + ".npz")
+
+    @classmethod
+    def load(cls, video_file_path):
+        try:
+            with np.load(cls.cachePath(video_file_path)) as data:
+                return cls(int(data["interval"]), data["frame_ids"], data["images"])
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def save(self, video_file_path):
+        os.makedirs(self.cacheDir(), exist_ok=True)
+        cache_path = self.cachePath(video_file_path)
+        tmp_path = cache_path + ".tmp.npz"
+        np.savez(tmp_path, interval=self.interval, frame_ids=self.frame_ids, images=self.images)
+        os.replace(tmp_path, cache_path)
+
+    @classmethod
+    def generate(cls, video_file_path, should_stop=None, progress_callback=None, progress_step=50):
+        cap = capture_pool.acquire(video_file_path)
+        if not cap.isOpened():
+            capture_pool.release(video_file_path, cap)
+            return None
+
+        if cap.get(cv.CAP_PROP_POS_FRAMES) != 0:
+            cap.set(cv.CAP_PROP_POS_FRAMES, 0)
+
+        # One thumbnail per second, less on long videos
+        frame_count = max(int(cap.get(cv.CAP_PROP_FRAME_COUNT)), 1)
+        fps = cap.get(cv.CAP_PROP_FPS)
+        interval = max(int(round(fps)) if fps > 0 else 1, -(-frame_count // cls.max_count), 1)
+
+        width = int(cap.get(cv.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv.CAP_PROP_FRAME_HEIGHT))
+        thumb_size = (max(1, int(round(cls.height * width / max(height, 1)))), cls.height)
+
+        # Preallocated from the estimated frame count, grown if it falls short
+        frame_ids = np.zeros(frame_count // interval + 1, dtype=np.int64)
+        images = np.zeros((len(frame_ids), thumb_size[1], thumb_size[0], 3), dtype=np.uint8)
+        count = 0
+
+        # Single sequential pass, only the sampled frames are retrieved
+        frame_id = 0
+        while cap.grab():
+            if should_stop is not None and should_stop():
+                capture_pool.release(video_file_path, cap)
+                return None
+
+            if frame_id % interval == 0:
+                retval, image = cap.retrieve()
+                if retval:
+                    if count == len(frame_ids):
+                        frame_ids = np.concatenate((frame_ids, np.zeros_like(frame_ids)))
+                        images = np.concatenate((images, np.zeros_like(images)))
+
+                    frame_ids[count] = frame_id
+                    thumb = cv.resize(image, thumb_size, interpolation=cv.INTER_AREA)
+                    cv.cvtColor(thumb, cv.COLOR_BGR2RGB, dst=images[count])
+                    count += 1
+
+                    # Slices are not written anymore, so they can be shown while the pass goes on
+                    if progress_callback is not None and count % progress_step == 0:
+                        progress_callback(cls(interval, frame_ids[:count], images[:count]))
+
+            frame_id += 1
+
+        capture_pool.release(video_file_path, cap)
+
+        return cls(interval, frame_ids[:count].copy(), images[:count].copy())
+
+    def nearestIndex(self, frame_id):
+        # Last thumbnail at or before frame_id
+        i = np.searchsorted(self.frame_ids, frame_id, side="right") - 1
+        return max(int(i), 0)
+
+    def toQImage(self, index):
+        # Shares the thumbnail buffer, which must outlive the QImage
+        image = self.images[index]
+        return QImage(image.data, image.shape[1], image.shape[0], image.strides[0], QImage.Format_RGB888)
+
+class ThumbnailGenerator(QThread):
+
+    thumbnails_ready = Signal(str, object)
+
+    def __init__(self, video_file_path):
+        super(ThumbnailGenerator, self).__init__()
+        self.video_file_path = video_file_path
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+        self.wait()
+
+    def run(self):
+        def onProgress(thumbnails):
+            self.thumbnails_ready.emit(self.video_file_path, thumbnails)
+
+        thumbnails = VideoThumbnails.generate(self.video_file_path, lambda: self.stopped, onProgress)
+        if thumbnails is None:
+            return
+
+        try:
+            thumbnails.save(self.video_file_path)
+        except OSError as error:
+            print(error)
+
+        self.thumbnails_ready.emit(self.video_file_path, thumbnails)
+
+def seekToFrame(cap, video_index, frame_id, next_frame=-1):
+    # Seek to the keyframe before frame_id and decode forward up to it,
+    # reusing the current position when it is already on the way
+    if not video_index.has_keyframes:
+        return cap.set(cv.CAP_PROP_POS_FRAMES, frame_id)
+
+    keyframe = video_index.nearestKeyframe(frame_id)
+    if next_frame < keyframe or next_frame > frame_id:
+        cap.set(cv.CAP_PROP_POS_FRAMES, keyframe)
+        next_frame = keyframe
+
+    for _ in range(frame_id - next_frame):
+        if not cap.grab():
+            return False
+
+    return True
+
+class PreviewFrame():
+    __slots__ = ("image", "width", "height")
+
+    def __init__(self, image, preview_size):
+        # Native frame size, the RGB preview is fitted in preview_size
+        self.height, self.width = image.shape[:2]
+
+        scale = min(preview_size[0] / self.width, preview_size[1] / self.height)
+        preview_width = max(1, int(round(self.width * scale)))
+        preview_height = max(1, int(round(self.height * scale)))
+
+        if (preview_width, preview_height) != (self.width, self.height):
+            image = cv.resize(image, (preview_width, preview_height), interpolation=cv.INTER_AREA if scale < 1 else cv.INTER_LINEAR)
+
+        # Convert in place, image is either the decoded frame or the resized copy
+        self.image = cv.cvtColor(image, cv.COLOR_BGR2RGB, dst=image)
+
+    @property
+    def nbytes(self):
+        return self.image.nbytes
+
+    def toQImage(self):
+        # Shares the preview buffer, which must outlive the QImage
+        return QImage(self.image.data, self.image.shape[1], self.image.shape[0], self.image.strides[0], QImage.Format_RGB888)
+
+class FrameProvider(QThread):
+
+    frame_ready = Signal(int)
+    frame_failed = Signal(int)
+
+    def __init__(self, cap, video_file_path, cache_size_mb=512, read_ahead=16, preview_size=(640, 480)):
+        super(FrameProvider, self).__init__()
+
+        # Frames are kept as RGB previews fitted in preview_size
+        self.preview_size = preview_size
+
+        # Capture is only used from the reader thread, it is returned to
+        # capture_pool on stop
+        self.cap = cap
+        self.video_file_path = video_file_path
+
+        # LRU cache of decoded frames
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        self.max_cache_bytes = cache_size_mb * 1024 * 1024
+
+        # Frame that the next cap.read() returns, -1 when unknown
+        self.next_frame = int(cap.get(cv.CAP_PROP_POS_FRAMES)) if cap.isOpened() else -1
+
+        # Frames decoded around the requested one in the direction of travel
+        self.read_ahead = read_ahead
+
+        # Keyframes index used for seeking, set once the video is scanned
+        self.video_index = None
+
+        self.lock = threading.Lock()
+        self.request_cond = threading.Condition(self.lock)
+        self.requested_frame = None
+        self.request_seq = 0
+        self.pending_ready = False
+        self.direction = 1
+        self.running = True
 
-    def buildYoloDirTree(self, base_dir, dataset_name):
-        def make_dir(dir_path):
+        # Last decoded frame, kept even when it does not fit in the cache
+        self.last_frame_id = None
+        self.last_image = None
+
+        self.start()
+
+    def stop(self):
+        with self.request_cond:
+            self.running = False
+            self.request_cond.notify()
+        self.wait()
+
+        capture_pool.release(self.video_file_path, self.cap)
+
+    def setCacheSize(self, cache_size_mb):
+        with self.lock:
+            self.max_cache_bytes = cache_size_mb * 1024 * 1024
+            self.evict()
+
+    def evict(self):
+        while self.cache_bytes > self.max_cache_bytes and len(self.cache) > 0:
+            _, image = self.cache.popitem(last=False)
+            self.cache_bytes -= image.nbytes
+
+    def cacheFrame(self, frame_id, image):
+        if image.nbytes > self.max_cache_bytes:
+            return
+
+        old_image = self.cache.pop(frame_id, None)
+        if old_image is not None:
+            self.cache_bytes -= old_image.nbytes
+
+        self.cache[frame_id] = image
+        self.cache_bytes += image.nbytes
+        self.evict()
+
+    def requestFrame(self, frame_id):
+        # Returns the frame if it is decoded, otherwise queues it and
+        # frame_ready is emitted once it is available
+        frame_id = int(frame_id)
+
+        with self.request_cond:
+            if self.requested_frame is not None:
+                prev_frame = self.requested_frame
+            else:
+                prev_frame = frame_id - self.direction
+            if frame_id != prev_frame:
+                self.direction = 1 if frame_id > prev_frame else -1
+
+            image = self.cache.get(frame_id)
+            if image is not None:
+                self.cache.move_to_end(frame_id)
+            elif frame_id == self.last_frame_id:
+                image = self.last_image
+
+            # Wake the reader to decode the frame or read ahead of it
+            if image is None or frame_id != self.requested_frame:
+                self.requested_frame = frame_id
+                self.request_seq += 1
+                self.pending_ready = image is None
+                self.request_cond.notify()
+
+        return image
+
+    def setIndex(self, video_index):
+        self.video_index = video_index
+
+    def readFrame(self, frame_id):
+        # Sequential reads avoid seeking back to the previous keyframe
+        if frame_id != self.next_frame:
+            with metrics.span("video.seek"):
+                if self.video_index is not None and self.video_index.has_keyframes:
+                    seekToFrame(self.cap, self.video_index, frame_id, self.next_frame)
+                else:
+                    self.cap.set(cv.CAP_PROP_POS_FRAMES, frame_id)
+
+        with metrics.span("video.decode"):
+            retval, image = self.cap.read()
+        if not retval:
+            self.next_frame = -1
+            return None
+
+        self.next_frame = frame_id + 1
+
+        with metrics.span("video.convert"):
+            image = PreviewFrame(image, self.preview_size)
+
+        with self.lock:
+            self.cacheFrame(frame_id, image)
+            self.last_frame_id = frame_id
+            self.last_image = image
+
+        return image
+
+    def isCached(self, frame_id):
+        with self.lock:
+            return frame_id in self.cache
+
+    def run(self):
+        served_seq = 0
+
+        while True:
+            with self.request_cond:
+                while self.running and self.request_seq == served_seq:
+                    self.request_cond.wait()
+
+                if not self.running:
+                    return
+
+                target_frame = self.requested_frame
+                direction = self.direction
+                notify_ready = self.pending_ready
+                served_seq = self.request_seq
+
+            if not self.isCached(target_frame):
+                if self.readFrame(target_frame) is None:
+                    self.frame_failed.emit(target_frame)
+                    continue
+            if notify_ready:
+                self.frame_ready.emit(target_frame)
+
+            # Decode ahead, always reading forward to keep reads sequential.
+            # Backward it jumps back a whole block once the cached frames run
+            # out, so it seeks once per block instead of once per step
+            if direction > 0:
+                ahead_frames = range(target_frame + 1, target_frame + self.read_ahead + 1)
+            elif target_frame > 0 and not self.isCached(target_frame - 1):
+                ahead_frames = range(max(target_frame - self.read_ahead, 0), target_frame)
+            else:
+                ahead_frames = range(0)
+
+            for frame_id in ahead_frames:
+                with self.lock:
+                    if not self.running or self.request_seq != served_seq:
+                        break
+                if not self.isCached(frame_id) and self.readFrame(frame_id) is None:
+                    break
+
+def matchBBoxes(bboxes_a, bboxes_b):
+    # Pairs bboxes with the same tag id, nearest centers first
+    if len(bboxes_a) == 0 or len(bboxes_b) == 0:
+        return []
+
+    def centers(bbox_tags):
+        return np.array([(b.rect.x() + b.rect.width() / 2, b.rect.y() + b.rect.height() / 2) for b in bbox_tags])
+
+    distances = np.linalg.norm(centers(bboxes_a)[:, None, :] - centers(bboxes_b)[None, :, :], axis=2)
+    tags_a = np.array([b.tag.id for b in bboxes_a])
+    tags_b = np.array([b.tag.id for b in bboxes_b])
+    distances[tags_a[:, None] != tags_b[None, :]] = np.inf
+
+    pairs = []
+    for _ in range(min(len(bboxes_a), len(bboxes_b))):
+        i, j = np.unravel_index(np.argmin(distances), distances.shape)
+        if not np.isfinite(distances[i, j]):
+            break
+        pairs.append((int(i), int(j)))
+        distances[i, :] = np.inf
+        distances[:, j] = np.inf
+
+    return pairs
+
+def interpolateBBoxes(bboxes_a, frame_a, bboxes_b, frame_b):
+    # Linear interpolation of the matched bboxes over the frames between
+    # frame_a and frame_b, returned as columns
+    if frame_a > frame_b:
+        bboxes_a, frame_a, bboxes_b, frame_b = bboxes_b, frame_b, bboxes_a, frame_a
+
+    pairs = matchBBoxes(bboxes_a, bboxes_b)
+    frame_ids = np.arange(frame_a + 1, frame_b, dtype=np.int32)
+
+    rects_a = np.array([bboxRectTuple(bboxes_a[i].rect) for i, _ in pairs], dtype=np.float64).reshape(-1, 4)
+    rects_b = np.array([bboxRectTuple(bboxes_b[j].rect) for _, j in pairs], dtype=np.float64).reshape(-1, 4)
+
+    # (frames, tracks, 4) in one step
+    t = (frame_ids - frame_a) / (frame_b - frame_a)
+    rects = np.rint(rects_a[None, :, :] + t[:, None, None] * (rects_b - rects_a)[None, :, :]).astype(np.int32)
+
+    return {
+        "x": rects[:, :, 0].ravel(),
+        "y": rects[:, :, 1].ravel(),
+        "w": rects[:, :, 2].ravel(),
+        "h": rects[:, :, 3].ravel(),
+        "tag_id": np.tile([bboxes_a[i].tag.id for i, _ in pairs], len(frame_ids)).astype(np.int32),
+        "tag_name": np.tile(np.array([bboxes_a[i].tag.name for i, _ in pairs], dtype=object), len(frame_ids)),
+        "frame_id": np.repeat(frame_ids, len(pairs))
+    }
+
+def bboxRectTuple(rect):
+    return (rect.x(), rect.y(), rect.width(), rect.height())
+
+def createBBoxTracker():
+    # CSRT and KCF need an opencv-contrib build, MIL is in the main modules
+    for name in ["TrackerCSRT_create", "TrackerKCF_create", "TrackerMIL_create"]:
+        create = getattr(cv, name, None)
+        if create is not None:
+            return create()
+    return None
+
+class BBoxTracker(QThread):
+
+    # Tracked frames count, and the tracked bboxes as columns once done
+    tracking_progress = Signal(int)
+    tracking_done = Signal(str, object)
+
+    def __init__(self, video_file_path, video_index, frame_id, bbox_tags, frames_count):
+        super(BBoxTracker, self).__init__()
+        self.video_file_path = video_file_path
+        self.video_index = video_index
+        self.frame_id = frame_id
+        self.bbox_tags = bbox_tags
+        self.frames_count = frames_count
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+        self.wait()
+
+    def run(self):
+        rows = []
+
+        cap = capture_pool.acquire(self.video_file_path)
+        if self.video_index is not None:
+            seekToFrame(cap, self.video_index, self.frame_id)
+        else:
+            cap.set(cv.CAP_PROP_POS_FRAMES, self.frame_id)
+
+        retval, image = cap.read()
+        trackers = []
+        if retval:
+            for bbox_tag in self.bbox_tags:
+                tracker = createBBoxTracker()
+                if tracker is None:
+                    break
+                tracker.init(image, bboxRectTuple(bbox_tag.rect))
+                trackers.append((tracker, bbox_tag.tag))
+
+        # Frames are read sequentially, tracks are dropped once lost
+        for i in range(1, self.frames_count + 1):
+            if self.stopped or len(trackers) == 0:
+                break
+
+            retval, image = cap.read()
+            if not retval:
+                break
+
+            tracked = []
+            for tracker, tag in trackers:
+                found, (x, y, w, h) = tracker.update(image)
+                if found:
+                    tracked.append((tracker, tag))
+                    rows.append((x, y, w, h, tag.id, tag.name, self.frame_id + i))
+            trackers = tracked
+
+            self.tracking_progress.emit(i)
+
+        capture_pool.release(self.video_file_path, cap)
+
+        x, y, w, h, tag_ids, tag_names, frame_ids = zip(*rows) if len(rows) > 0 else [()] * 7
+        self.tracking_done.emit(self.video_file_path, {
+            "x": np.array(x, dtype=np.int32),
+            "y": np.array(y, dtype=np.int32),
+            "w": np.array(w, dtype=np.int32),
+            "h": np.array(h, dtype=np.int32),
+            "tag_id": np.array(tag_ids, dtype=np.int32),
+            "tag_name": np.array(tag_names, dtype=object),
+            "frame_id": np.array(frame_ids, dtype=np.int32)
+        })
+
+class DirectorySink():
+
+    # Exported files are written to root_dir, which workers can write to directly
+
+    def __init__(self, root_dir):
+        self.directory = root_dir
+
+    def path(self, rel_path):
+        return os.path.join(self.directory, rel_path)
+
+    def makeDir(self, rel_path):
+        os.makedirs(self.path(rel_path), exist_ok=True)
+
+    def read(self, rel_path):
+        try:
+            with open(self.path(rel_path), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def has(self, rel_path):
+        return os.path.exists(self.path(rel_path))
+
+    def keep(self, rel_path):
+        pass
+
+    def write(self, rel_path, data):
+        tmp_path = self.path(rel_path) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path(rel_path))
+
+    def remove(self, rel_path):
+        try:
+            os.remove(self.path(rel_path))
+            return True
+        except OSError:
+            return False
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+class ZipSink():
+
+    # Exported files are appended to the previous zip archive, replaced and
+    # dropped entries are left out of its central directory and their bytes
+    # are reclaimed once they outweigh the live entries. Without a readable
+    # previous archive a new one is written next to it
+
+    def __init__(self, archive_path, compress=False):
+        self.directory = None
+        self.archive_path = archive_path
+        self.tmp_path = archive_path + ".tmp"
+        self.compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+        self.touched = set()
+
+        self.archive = None
+        if os.path.exists(archive_path):
             try:
-                os.mkdir(dir_path)
-            except OSError as error:
+                # Mode "a" would append a new archive to an unreadable file
+                with zipfile.ZipFile(archive_path):
+                    pass
+                self.archive = zipfile.ZipFile(archive_path, "a", compression=self.compression)
+            except zipfile.BadZipFile as error:
                 print(error)
+        self.prev_names = set(self.archive.namelist()) if self.archive is not None else set()
+
+        self.append_offset = None
+        if self.archive is not None:
+            # Appended entries overwrite the old central directory, abort puts it back
+            self.append_offset = self.archive.start_dir
+            with open(archive_path, "rb") as file:
+                file.seek(self.append_offset)
+                self.tail = file.read()
+        else:
+            self.archive = zipfile.ZipFile(self.tmp_path, "w", compression=self.compression)
+
+    def dropEntry(self, name):
+        info = self.archive.NameToInfo.pop(name, None)
+        if info is not None:
+            self.archive.filelist.remove(info)
+
+    def makeDir(self, rel_path):
+        name = rel_path.replace(os.sep, "/") + "/"
+        self.touched.add(name)
+        if name not in self.archive.NameToInfo:
+            self.archive.writestr(name, b"")
+
+    def read(self, rel_path):
+        name = rel_path.replace(os.sep, "/")
+        if name not in self.prev_names:
+            return None
+        return self.archive.read(name)
+
+    def has(self, rel_path):
+        return rel_path.replace(os.sep, "/") in self.prev_names
+
+    def keep(self, rel_path):
+        self.touched.add(rel_path.replace(os.sep, "/"))
+
+    def write(self, rel_path, data):
+        name = rel_path.replace(os.sep, "/")
+        self.touched.add(name)
+        self.dropEntry(name)
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        info.compress_type = self.compression
+        self.archive.writestr(info, data)
+
+    def remove(self, rel_path):
+        self.dropEntry(rel_path.replace(os.sep, "/"))
+        return self.has(rel_path)
+
+    def close(self):
+        if self.append_offset is None:
+            self.archive.close()
+            os.replace(self.tmp_path, self.archive_path)
+            return
 
+        # Entries neither kept nor written are left out, as in a full export
+        for name in self.prev_names - self.touched:
+            self.dropEntry(name)
+
+        live_size = sum(info.compress_size + len(info.FileHeader()) for info in self.archive.filelist)
+        if self.archive.start_dir - live_size > live_size:
+            self.compact()
+        else:
+            self.archive.close()
+
+    def compact(self):
+        with zipfile.ZipFile(self.tmp_path, "w") as archive:
+            for info in self.archive.infolist():
+                archive.writestr(info, self.archive.read(info))
+        self.archive.close()
+        os.replace(self.tmp_path, self.archive_path)
+
+    def abort(self):
+        # Keep the previous archive
+        self.archive.close()
+        if self.append_offset is None:
+            os.remove(self.tmp_path)
+            return
+        with open(self.archive_path, "r+b") as file:
+            file.seek(self.append_offset)
+            file.write(self.tail)
+            file.truncate()
+
+class TarSink():
+
+    # Exported files are appended to the previous uncompressed tar archive, a
+    # later member replaces an earlier one of the same name. Tar has no index
+    # to drop members from, so the archive is rewritten when entries must be
+    # dropped or replaced members outweigh the live ones. Compressed archives
+    # cannot be appended to and are always written anew
+
+    def __init__(self, archive_path, compress=False):
+        self.directory = None
+        self.archive_path = archive_path
+        self.tmp_path = archive_path + ".tmp"
+        self.touched = set()
+        self.rewrite = False
+        self.dead_size = 0
+
+        self.prev_archive = None
+        self.prev_members = {}
+        if os.path.exists(archive_path):
+            try:
+                self.prev_archive = tarfile.open(archive_path, "r:*")
+                for member in self.prev_archive.getmembers():
+                    if member.name in self.prev_members:
+                        self.dead_size += self.prev_members[member.name].size
+                    self.prev_members[member.name] = member
+            except tarfile.TarError as error:
+                print(error)
+                self.prev_archive = None
+                self.prev_members = {}
+
+        self.append_offset = None
+        if self.prev_archive is not None and not compress:
+            self.archive = tarfile.open(archive_path, "a")
+            self.members = dict(self.prev_members)
+            # Appended members overwrite the end of archive blocks, abort puts them back
+            self.append_offset = self.archive.offset
+            with open(archive_path, "rb") as file:
+                file.seek(self.append_offset)
+                self.tail = file.read()
+        else:
+            self.archive = tarfile.open(self.tmp_path, "w:gz" if compress else "w")
+            self.members = {}
+
+    def makeDir(self, rel_path):
+        name = rel_path.replace(os.sep, "/")
+        self.touched.add(name)
+        if name in self.members:
+            return
+        info = tarfile.TarInfo(name)
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+        info.mtime = time.time()
+        self.archive.addfile(info)
+        self.members[name] = info
+
+    def read(self, rel_path):
+        member = self.prev_members.get(rel_path.replace(os.sep, "/"))
+        if member is None:
+            return None
+        return self.prev_archive.extractfile(member).read()
+
+    def has(self, rel_path):
+        return rel_path.replace(os.sep, "/") in self.prev_members
+
+    def keep(self, rel_path):
+        if self.append_offset is None:
+            self.write(rel_path, self.read(rel_path))
+        else:
+            self.touched.add(rel_path.replace(os.sep, "/"))
+
+    def write(self, rel_path, data):
+        name = rel_path.replace(os.sep, "/")
+        self.touched.add(name)
+        if name in self.members:
+            self.dead_size += self.members[name].size
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mode = 0o644
+        info.mtime = time.time()
+        self.archive.addfile(info, io.BytesIO(data))
+        self.members[name] = info
+
+    def remove(self, rel_path):
+        # Entries not kept are left out of a new archive
+        if self.members.pop(rel_path.replace(os.sep, "/"), None) is not None and self.append_offset is not None:
+            self.rewrite = True
+        return self.has(rel_path)
+
+    def close(self):
+        if self.append_offset is not None:
+            # Entries neither kept nor written are left out, as in a full export
+            for name in set(self.prev_members) - self.touched:
+                if self.members.pop(name, None) is not None:
+                    self.rewrite = True
+            if self.dead_size > sum(member.size for member in self.members.values()):
+                self.rewrite = True
+
+        self.archive.close()
+        if self.prev_archive is not None:
+            self.prev_archive.close()
+        if self.append_offset is None:
+            os.replace(self.tmp_path, self.archive_path)
+        elif self.rewrite:
+            self.compact()
+
+    def compact(self):
+        with tarfile.open(self.archive_path, "r") as source, tarfile.open(self.tmp_path, "w") as archive:
+            latest = {}
+            for member in source.getmembers():
+                latest[member.name] = member
+            for name, member in latest.items():
+                if name in self.members:
+                    archive.addfile(member, source.extractfile(member) if member.isfile() else None)
+        os.replace(self.tmp_path, self.archive_path)
+
+    def abort(self):
+        # Keep the previous archive
+        self.archive.close()
+        if self.prev_archive is not None:
+            self.prev_archive.close()
+        if self.append_offset is None:
+            os.remove(self.tmp_path)
+            return
+        with open(self.archive_path, "r+b") as file:
+            file.seek(self.append_offset)
+            file.write(self.tail)
+            file.truncate()
+
+class YoloExporter():
+
+    def __init__(self, base_dir, dataset_name, workers=1, frames_per_job=100, max_grab_gap=250, image_format="jpg", incremental=True, sink="zip", compress=False, dedup_distance=None, dedup_iou=0.9):
+        self.base_dir = base_dir
+        self.dataset_name = dataset_name
+        self.image_format = image_format
+
+        # Output written to a "dir" under base_dir or streamed into a "zip" or "tar"
+        # archive in base_dir, with compressed or stored entries
+        self.sink = sink
+        self.compress = compress
+
+        # Only export frames changed since the last export, as recorded in the manifest
+        self.incremental = incremental
+
+        # Videos are split in jobs of frames_per_job labeled frames run by workers processes
+        self.workers = workers
+        self.frames_per_job = frames_per_job
+
+        # Archive sinks get the encoded frames back from the workers, their jobs are
+        # smaller and the results of the jobs in flight are kept under max_pending_bytes
+        self.archive_frames_per_job = 20
+        self.max_pending_bytes = 256 * 1024 * 1024
+
+        # Longest run of frames decoded with grab() instead of seeking,
+        # used when the video has no keyframes index
+        self.max_grab_gap = max_grab_gap
+
+        # Frames within dedup_distance bits (of 64) of a kept frame of the same
+        # video, with bboxes overlapping by dedup_iou, are pruned. None exports all
+        self.dedup_distance = dedup_distance
+        self.dedup_iou = dedup_iou
+
+        # Decoded frames hashed together when pruning, they are held until encoded
+        self.dedup_batch_size = 8
+
+    def outputPath(self):
+        if self.sink == "zip":
+            return os.path.join(self.base_dir, self.dataset_name + ".zip")
+        elif self.sink == "tar":
+            return os.path.join(self.base_dir, self.dataset_name + (".tar.gz" if self.compress else ".tar"))
+        return os.path.join(self.base_dir, self.dataset_name)
+
+    def createSink(self):
+        # Archives are opened in base_dir before the dataset tree is created
+        os.makedirs(self.base_dir, exist_ok=True)
+
+        if self.sink == "zip":
+            return ZipSink(self.outputPath(), self.compress)
+        elif self.sink == "tar":
+            return TarSink(self.outputPath(), self.compress)
+        return DirectorySink(self.base_dir)
+
+    def buildYoloDirTree(self, sink):
         def create_dataset_subdirs(parent_dir):
         
             train_dir = os.path.join(parent_dir, "train")
             val_dir = os.path.join(parent_dir, "val")
             test_dir = os.path.join(parent_dir, "test")
 
-            make_dir(train_dir)
-            make_dir(val_dir)
-            make_dir(test_dir)
+            sink.makeDir(train_dir)
+            sink.makeDir(val_dir)
+            sink.makeDir(test_dir)
 
             return train_dir, val_dir, test_dir
 
-        # Create Directory Tree
-        # TODO Get base dir name from user input
-        make_dir(base_dir)
+        # Create Directory Tree, relative to the sink root
+        os.makedirs(self.base_dir, exist_ok=True)
 
-        dataset_dir = os.path.join(base_dir, dataset_name)
-        make_dir(dataset_dir)
-
-        images_dir = os.path.join(dataset_dir, "images")
-        labels_dir = os.path.join(dataset_dir, "labels")
-
-        make_dir(images_dir)
-        make_dir(labels_dir)
+        images_dir = os.path.join(self.dataset_name, "images")
+        labels_dir = os.path.join(self.dataset_name, "labels")
 
         images_train_dir, images_val_dir, images_test_dir = create_dataset_subdirs(images_dir)
         labels_train_dir, labels_val_dir, labels_test_dir = create_dataset_subdirs(labels_dir)
 
         return images_train_dir, images_val_dir, images_test_dir, labels_train_dir, labels_val_dir, labels_test_dir
 
-    def onGenYoloDataButtonClick(self):
-        print("Generate Yolo Dataset")
-
-        base_dir = "./custom_dataset"
-        dataset_name = "minesign_dataset"
-        img_train_dir, img_val_dir, img_test_dir, lbl_train_dir, lbl_val_dir, lbl_test_dir =  self.buildYoloDirTree(base_dir, dataset_name)
-        
-        # Load all videos of dataset
-        video_file_names = [bbox_tag.file_name for bbox_tag in self.tags_dataset.bbox_tags]
-
-        # Build dictionary of frames and files
-        bboxes_dict = dict.fromkeys(video_file_names)
-        for bbox_tag in self.tags_dataset.bbox_tags:
-            file_name = bbox_tag.file_name
-            frame_id = bbox_tag.frame_id
-            class_id = bbox_tag.tag.id
-            center_x = bbox_tag.rect.left()
-            center_y = bbox_tag.rect.top()
-            bbox_width = bbox_tag.rect.width()
-            bbox_height = bbox_tag.rect.height()
-
-            # class_id, center_x, center_y, bbox_width, bbox_height
-            bbox_tuple = (class_id, center_x, center_y, bbox_width, bbox_height)
-
-            if bboxes_dict[file_name] is None:
-                bboxes_dict[file_name] = { frame_id: [bbox_tuple]}
-            elif frame_id not in bboxes_dict[file_name]:
-                bboxes_dict[file_name][frame_id] = [bbox_tuple]  
-            elif bbox_tuple not in bboxes_dict[file_name][frame_id]:
-                    bboxes_dict[file_name][frame_id].append(bbox_tuple)
-                
-        frame_count = 0
-        for file_name in bboxes_dict:
-            cap = cv.VideoCapture(file_name)
-
-            if cap:
-                
-                for frame_id in bboxes_dict[file_name]:
-                
-                    # Set frame position
-                    cap.set(cv.CAP_PROP_POS_FRAMES, frame_id)
+    def readFrames(self, file_name, frame_ids):
+        # Decode frame_ids (sorted) in a single forward pass, seeking only
+        # when it skips decoding frames
+        cap = capture_pool.acquire(file_name)
+        if not cap.isOpened():
+            print("Cannot open {}".format(file_name))
+            capture_pool.release(file_name, cap)
+            return
 
-                    # Get image
+        # Without keyframes max_grab_gap decides when to seek
+        video_index = VideoIndex.load(file_name)
+        if video_index is not None and not video_index.has_keyframes:
+            video_index = None
+
+        try:
+            next_frame = int(cap.get(cv.CAP_PROP_POS_FRAMES))
+            for frame_id in frame_ids:
+                if video_index is not None:
+                    seek = video_index.nearestKeyframe(frame_id) > next_frame
+                else:
+                    seek = frame_id - next_frame > self.max_grab_gap
+
+                with metrics.span("export.seek"):
+                    if seek or frame_id < next_frame:
+                        if video_index is not None:
+                            seekToFrame(cap, video_index, frame_id)
+                        else:
+                            cap.set(cv.CAP_PROP_POS_FRAMES, frame_id)
+                    else:
+                        for _ in range(frame_id - next_frame):
+                            if not cap.grab():
+                                break
+
+                with metrics.span("export.decode"):
                     retval, image = cap.read()
-                    if retval:
-                        cv.imwrite(os.path.join(img_train_dir, f'train{frame_count}.jpg'), image)
-                    
-                    # Write bboxes 
-                    lines = ['# class_id center_x center_y bbox_width bbox_height']
-                    for bbox_tuple in bboxes_dict[file_name][frame_id]:
-                        lines.append(f'{bbox_tuple[0]} {bbox_tuple[1] / image.shape[1]:.6f} {bbox_tuple[2] / image.shape[0]:.6f} {bbox_tuple[3] / image.shape[1]:.6f} {bbox_tuple[4] / image.shape[0]:.6f}')
-                    with open(os.path.join(lbl_train_dir, f'train{frame_count}.txt'), 'w') as f:
-                        for line in lines:
-                            f.write(line)
-                            f.write('\n')
-                    
-                    frame_count += 1
-
-
-        # Create .zip with dataset
-        shutil.make_archive(dataset_name, 'zip', base_dir)
-
-        # Remove dataset folder
+                next_frame = frame_id + 1
+
+                if retval:
+                    yield frame_id, image
+                else:
+                    print("Cannot retrieve frame {} of {}".format(frame_id, file_name))
+        finally:
+            capture_pool.release(file_name, cap)
+
+    def exportFrames(self, file_name, frames, img_dir, lbl_dir, output_dir=None):
+        # Export frames, a sorted list of (frame_id, frame_index, bbox_tuples, perceptual_hash,
+        # write_files) of file_name. Files are written under output_dir when it is set and
+        # returned otherwise. Returns (frame_id, perceptual_hash, exported, entries) for each
+        # frame read, entries being a list of (path, data).
+        # When pruning, frames without perceptual_hash are hashed and a frame duplicating one
+        # kept by this job is not encoded, the frames pruned are decided over the whole video
+        frames_dict = {frame[0]: frame[1:] for frame in frames}
+        deduplicator = FrameDeduplicator(self.dedup_distance, self.dedup_iou) if self.dedup_distance is not None else None
+
+        def batches():
+            # Frames are hashed dedup_batch_size at a time
+            batch_size = self.dedup_batch_size if deduplicator is not None else 1
+            batch = []
+            for frame in self.readFrames(file_name, [frame[0] for frame in frames]):
+                batch.append(frame)
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+            if len(batch) > 0:
+                yield batch
+
+        results = []
+        for batch in batches():
+            frame_hashes = [frames_dict[frame_id][2] for frame_id, _ in batch]
+            unknown = [i for i, frame_hash in enumerate(frame_hashes) if frame_hash is None]
+            if deduplicator is not None and len(unknown) > 0:
+                with metrics.span("export.hash"):
+                    hashes = perceptualHashes(np.stack([hashThumbnail(batch[i][1]) for i in unknown])).tolist()
+                for i, frame_hash in zip(unknown, hashes):
+                    frame_hashes[i] = frame_hash
+
+            for (frame_id, image), frame_hash in zip(batch, frame_hashes):
+                frame_index, bbox_tuples, _, write_files = frames_dict[frame_id]
+
+                # Duplicates are dropped before they are encoded
+                if deduplicator is not None and deduplicator.check(frame_id, frame_hash, bbox_tuples) is not None:
+                    write_files = False
+                if not write_files:
+                    results.append((frame_id, frame_hash, False, []))
+                    continue
+
+                with metrics.span("export.encode"):
+                    retval, image_data = cv.imencode(f'.{self.image_format}', image)
+                if not retval:
+                    print("Cannot encode frame {} of {}".format(frame_id, file_name))
+                    continue
+
+                # Write bboxes 
+                lines = ['# class_id center_x center_y bbox_width bbox_height']
+                for bbox_tuple in bbox_tuples:
+                    lines.append(f'{bbox_tuple[0]} {bbox_tuple[1] / image.shape[1]:.6f} {bbox_tuple[2] / image.shape[0]:.6f} {bbox_tuple[3] / image.shape[1]:.6f} {bbox_tuple[4] / image.shape[0]:.6f}')
+                label_data = "".join(line + "\n" for line in lines).encode()
+
+                frame_entries = [
+                    (os.path.join(img_dir, f'train{frame_index}.{self.image_format}'), image_data.tobytes()),
+                    (os.path.join(lbl_dir, f'train{frame_index}.txt'), label_data)
+                ]
+                if output_dir is not None:
+                    for rel_path, data in frame_entries:
+                        with open(os.path.join(output_dir, rel_path), "wb") as f:
+                            f.write(data)
+                    frame_entries = []
 
-    def saveLabels(self):
+                results.append((frame_id, frame_hash, True, frame_entries))
 
-        try:        
-            file = open(self.labels_path, "w")
+        return results
 
-            try:
-            
-                for tag in self.tags:
-                    if tag.id > 0:
-                        file.write(str(tag) + "\n")
+    def manifestPath(self):
+        return os.path.join(self.dataset_name, "manifest.json")
 
-                showMessage("Labels saved to {}".format(self.labels_path))
-            except:
-                showMessage("Something went wrong when writing to file {}".format(self.labels_path))
-            finally:
-                file.close()
-        except:
-            showMessage("Something went worng when opening the file {}".format(self.labels_path))
+    def loadManifest(self, sink):
+        data = sink.read(self.manifestPath())
+        if data is not None:
+            try:
+                return json.loads(data)
+            except ValueError:
+                pass
+        return {"videos": {}, "frames": {}}
+
+    def saveManifest(self, sink, manifest):
+        sink.write(self.manifestPath(), json.dumps(manifest).encode())
+
+    def prunedReportPath(self):
+        return os.path.join(self.dataset_name, "pruned.csv")
+
+    def frameHash(self, video_key, bbox_tuples):
+        hasher = hashlib.sha1(video_key.encode())
+        hasher.update(self.image_format.encode())
+        hasher.update(repr(bbox_tuples).encode())
+        return hasher.hexdigest()
+
+    def videoKey(self, file_name):
+        try:
+            return VideoIndex.cacheKey(file_name)
+        except OSError:
+            return ""
+
+    def knownPerceptualHash(self, manifest, file_name, video_key, frame_id):
+        # Perceptual hash of a frame from a previous export of the same video,
+        # it does not depend on the bboxes
+        old_entry = manifest["frames"].get("{}:{}".format(file_name, frame_id))
+        if old_entry is None or "phash" not in old_entry or manifest["videos"].get(file_name) != video_key:
+            return None
+        return int(old_entry["phash"], 16)
+
+    def jobFramesCount(self, sink):
+        if sink.directory is not None:
+            return self.frames_per_job
+        return min(self.frames_per_job, self.archive_frames_per_job)
+
+    def buildJobs(self, bboxes_dict, manifest, sink):
+        # Frames keep the index they had in the previous export, new frames
+        # are numbered after them in sorted order, so numbering only depends
+        # on the dataset and not on the number of workers.
+        # Returns the jobs of the frames to decode, to write their files or,
+        # when pruning, to hash them, the videos manifest and the frames of
+        # each video as (frame_id, key, entry, bbox_tuples, current, decoded).
+        # current frames have their files from a previous export
+        old_frames = manifest["frames"]
+        next_index = max((entry["index"] + 1 for entry in old_frames.values()), default=0)
+
+        jobs = []
+        videos_frames = {}
+        job_frames_count = self.jobFramesCount(sink)
+        videos_manifest = {}
+        for file_name in bboxes_dict:
+            frames_dict = bboxes_dict[file_name]
+
+            video_key = self.videoKey(file_name)
+            videos_manifest[file_name] = video_key
+
+            video_frames = []
+            frames = []
+            for frame_id in sorted(frames_dict):
+                key = "{}:{}".format(file_name, frame_id)
+                bbox_tuples = frames_dict[frame_id]
+
+                old_entry = old_frames.get(key)
+                if old_entry is not None:
+                    frame_index = old_entry["index"]
+                else:
+                    frame_index = next_index
+                    next_index += 1
+
+                entry = {
+                    "index": frame_index,
+                    "hash": self.frameHash(video_key, bbox_tuples),
+                    "image": os.path.join(self.dataset_name, "images", "train", f'train{frame_index}.{self.image_format}'),
+                    "label": os.path.join(self.dataset_name, "labels", "train", f'train{frame_index}.txt')
+                }
+
+                perceptual_hash = self.knownPerceptualHash(manifest, file_name, video_key, frame_id)
+                if perceptual_hash is not None:
+                    entry["phash"] = format(perceptual_hash, "016x")
+
+                # Files do not depend on the perceptual hash
+                current = old_entry is not None and all(old_entry.get(name) == entry[name] for name in ("index", "hash", "image", "label"))
+                current = current and sink.has(entry["image"]) and sink.has(entry["label"])
+
+                decoded = not current or (self.dedup_distance is not None and perceptual_hash is None)
+                if decoded:
+                    frames.append((frame_id, frame_index, bbox_tuples, perceptual_hash, not current))
+                video_frames.append((frame_id, key, entry, bbox_tuples, current, decoded))
+
+            videos_frames[file_name] = video_frames
+            for start in range(0, len(frames), job_frames_count):
+                jobs.append((file_name, frames[start:start + job_frames_count]))
+
+        return jobs, videos_manifest, videos_frames
+
+    def removeStaleFrames(self, sink, old_manifest, new_manifest):
+        # Pruned frames have no files
+        new_paths = set()
+        for entry in new_manifest["frames"].values():
+            new_paths.add(entry.get("image"))
+            new_paths.add(entry.get("label"))
+
+        removed_count = 0
+        for entry in old_manifest["frames"].values():
+            for path in (entry.get("image"), entry.get("label")):
+                if path is not None and path not in new_paths and sink.remove(path):
+                    removed_count += 1
+
+        return removed_count
+
+    def runJobs(self, function, jobs, args, on_result, result_bytes=None):
+        # Run function(file_name, frames, *args) for each (file_name, frames) job,
+        # on_result(file_name, frames, result) is called in jobs order and
+        # exceptions it raises stop the jobs. result_bytes(result) is the memory
+        # held by a result, used to bound the jobs in flight
+        if self.workers > 1 and len(jobs) > 1:
+            # Bound jobs in flight, their results are held until handled.
+            # Workers are spawned, forking would copy locks held by the other threads
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=initExportWorker, mp_context=multiprocessing.get_context("spawn")) as executor:
+                pending = deque()
+                # Frames of the pending jobs and largest result bytes per frame seen
+                pending_frames = 0
+                frame_bytes = None
+
+                def pendingFull(job):
+                    if frame_bytes is None:
+                        # One job per worker until the size of a result is known
+                        return len(pending) >= (self.workers if result_bytes is not None else 2 * self.workers)
+                    return len(pending) >= 2 * self.workers or (pending_frames + len(job[1])) * frame_bytes > self.max_pending_bytes
+
+                def handleOldest():
+                    nonlocal pending_frames, frame_bytes
+                    done_job, future = pending.popleft()
+                    result = future.result()
+                    pending_frames -= len(done_job[1])
+                    if result_bytes is not None:
+                        frame_bytes = max(frame_bytes or 0, result_bytes(result) / max(len(done_job[1]), 1))
+                    on_result(*done_job, result)
+
+                try:
+                    for job in jobs:
+                        while len(pending) > 0 and pendingFull(job):
+                            handleOldest()
+                        pending.append((job, executor.submit(function, *job, *args)))
+                        pending_frames += len(job[1])
+
+                    while len(pending) > 0:
+                        handleOldest()
+                except BaseException:
+                    # Jobs not started yet are dropped when the export is canceled
+                    for _, future in pending:
+                        future.cancel()
+                    raise
+        else:
+            for job in jobs:
+                on_result(*job, function(*job, *args))
+
+    @timed("export.total")
+    def export(self, tags_dataset, dataset_lock=None, progress_callback=None):
+        # dataset_lock is only held while the bboxes are read. progress_callback
+        # can raise to cancel the export, the sink is aborted and the manifest
+        # is not updated then. Returns the exported, unchanged, pruned and
+        # removed frame counts
+        sink = self.createSink()
+        try:
+            counts = self.exportToSink(tags_dataset, sink, dataset_lock, progress_callback)
+        except BaseException:
+            sink.abort()
+            raise
+
+        with metrics.span("export.close_sink"):
+            sink.close()
+
+        return counts
+
+    def exportToSink(self, tags_dataset, sink, dataset_lock=None, progress_callback=None):
+        img_train_dir, img_val_dir, img_test_dir, lbl_train_dir, lbl_val_dir, lbl_test_dir = self.buildYoloDirTree(sink)
+
+        old_manifest = self.loadManifest(sink)
+
+        # Without incremental export every frame is renumbered and rewritten
+        prev_manifest = old_manifest if self.incremental else {"videos": {}, "frames": {}}
+
+        # Build dictionary of frames and files, dataset_lock is only held while the bboxes are copied
+        with metrics.span("export.get_bboxes"):
+            bboxes_dict = tags_dataset.getBBoxesDict(dataset_lock)
+        with metrics.span("export.build_jobs"):
+            jobs, videos_manifest, videos_frames = self.buildJobs(bboxes_dict, prev_manifest, sink)
+
+        manifest = {"videos": videos_manifest, "frames": {}}
+        deduplicators = {file_name: FrameDeduplicator(self.dedup_distance, self.dedup_iou) for file_name in videos_frames} if self.dedup_distance is not None else {}
+        decided_counts = {file_name: 0 for file_name in videos_frames}
+        frame_results = {}
+        retried_frames = {}
+        counts = {"exported": 0, "removed": 0}
+
+        def decide_frames(file_name, last_frame_id=None):
+            # Frames of a video are decided in order, up to last_frame_id, once
+            # the jobs decoding them are done. A frame is pruned when it
+            # duplicates a kept frame before it in the video, whatever changed
+            # since the previous export
+            video_frames = videos_frames[file_name]
+            deduplicator = deduplicators.get(file_name)
+            while decided_counts[file_name] < len(video_frames):
+                frame_id, key, entry, bbox_tuples, current, decoded = video_frames[decided_counts[file_name]]
+                if last_frame_id is not None and frame_id > last_frame_id:
+                    break
+                decided_counts[file_name] += 1
+
+                # Frames that could not be read are retried in the next export
+                result = frame_results.pop(key, None)
+                if decoded and result is None:
+                    continue
+                frame_hash, exported, entries = result if result is not None else (None, False, [])
+
+                if frame_hash is not None:
+                    entry["phash"] = format(frame_hash, "016x")
+                manifest["frames"][key] = entry
+
+                if deduplicator is not None:
+                    with metrics.span("export.dedup"):
+                        duplicate = deduplicator.check(frame_id, int(entry["phash"], 16), bbox_tuples)
+                    if duplicate is not None:
+                        # Files written by a worker are removed, the others are not written
+                        for path in (entry.pop("image"), entry.pop("label")):
+                            if exported and sink.directory is not None and sink.remove(path):
+                                counts["removed"] += 1
+                        entry["pruned"] = {"frame_id": duplicate[0], "distance": duplicate[1]}
+                        continue
+
+                if current:
+                    sink.keep(entry["image"])
+                    sink.keep(entry["label"])
+                elif exported:
+                    for rel_path, data in entries:
+                        sink.write(rel_path, data)
+                    counts["exported"] += 1
+                else:
+                    # Only pruned by its job, as the duplicate of a frame pruned
+                    # over the video, it is decoded again
+                    retried_frames.setdefault(file_name, []).append((frame_id, entry["index"], bbox_tuples, frame_hash, True))
+
+        # progress_callback(done_frames, total_frames) counts decoded frames
+        done_frames = 0
+        total_frames = sum(len(frames) for _, frames in jobs)
+        def add_progress(frame_count):
+            nonlocal done_frames
+            done_frames += frame_count
+            if progress_callback is not None:
+                progress_callback(done_frames, total_frames + sum(len(frames) for frames in retried_frames.values()))
+
+        def exportedBytes(results):
+            return sum(len(data) for _, _, _, entries in results for _, data in entries)
+
+        def add_result(file_name, frames, results):
+            for frame_id, frame_hash, exported, entries in results:
+                frame_results["{}:{}".format(file_name, frame_id)] = (frame_hash, exported, entries)
+            decide_frames(file_name, frames[-1][0])
+            add_progress(len(frames))
+
+        def add_retried_result(file_name, frames, results):
+            exported_frames = set()
+            for frame_id, _, exported, entries in results:
+                for rel_path, data in entries:
+                    sink.write(rel_path, data)
+                exported_frames.add(frame_id)
+            counts["exported"] += len(exported_frames)
+
+            for frame in frames:
+                if frame[0] not in exported_frames:
+                    del manifest["frames"]["{}:{}".format(file_name, frame[0])]
+            add_progress(len(frames))
+
+        # Seek, decode and encode are only timed here when frames are exported in this process
+        with metrics.span("export.run_jobs"):
+            self.runJobs(self.exportFrames, jobs, (img_train_dir, lbl_train_dir, sink.directory), add_result, exportedBytes)
+            for file_name in videos_frames:
+                decide_frames(file_name)
+
+            # Kept frames are never duplicates of each other, none is pruned again
+            retried_jobs = []
+            job_frames_count = self.jobFramesCount(sink)
+            for file_name, frames in retried_frames.items():
+                for start in range(0, len(frames), job_frames_count):
+                    retried_jobs.append((file_name, frames[start:start + job_frames_count]))
+            self.runJobs(self.exportFrames, retried_jobs, (img_train_dir, lbl_train_dir, sink.directory), add_retried_result, exportedBytes)
+
+        with metrics.span("export.remove_stale"):
+            counts["removed"] += self.removeStaleFrames(sink, old_manifest, manifest)
+
+        pruned_count = self.savePrunedReport(sink, manifest)
+        self.saveManifest(sink, manifest)
+
+        unchanged_count = len(manifest["frames"]) - counts["exported"] - pruned_count
+        print("Exported {} frames, {} unchanged, {} pruned, {} stale files removed".format(counts["exported"], unchanged_count, pruned_count, counts["removed"]))
+        if pruned_count > 0:
+            print("Pruned frames are listed in {}".format(self.prunedReportPath()))
+
+        return counts["exported"], unchanged_count, pruned_count, counts["removed"]
+
+    def savePrunedReport(self, sink, manifest):
+        # One row per pruned frame with the kept frame it duplicates
+        report = io.StringIO()
+        writer = csv.writer(report, lineterminator="\n")
+        writer.writerow(["file_name", "frame_id", "kept_frame_id", "distance"])
+
+        pruned_count = 0
+        for key, entry in manifest["frames"].items():
+            if "pruned" in entry:
+                file_name, frame_id = key.rsplit(":", 1)
+                writer.writerow([file_name, frame_id, entry["pruned"]["frame_id"], entry["pruned"]["distance"]])
+                pruned_count += 1
+
+        if self.dedup_distance is not None:
+            sink.write(self.prunedReportPath(), report.getvalue().encode())
+        else:
+            sink.remove(self.prunedReportPath())
+
+        return pruned_count
+
+def initExportWorker():
+    # Parallelism comes from the worker processes
+    cv.setNumThreads(1)
+
+class FrameDeduplicator():
+
+    # Near-duplicate frames of a video, checked in frame order. A frame is
+    # dropped when its perceptual hash is within max_distance bits of an
+    # already kept frame whose bboxes are similar, so the frame adds nothing
+    # to the dataset
+
+    def __init__(self, max_distance, min_iou, capacity=64):
+        self.max_distance = max_distance
+        self.min_iou = min_iou
+
+        # Kept frames as (frame_id, bbox_tuples) and their hashes, in a
+        # buffer grown by half when full
+        self.frames = []
+        self.hashes = np.zeros(capacity, dtype=np.uint64)
+
+    def check(self, frame_id, frame_hash, bbox_tuples):
+        # Returns (kept_frame_id, distance) when frame_id, with perceptual hash
+        # frame_hash, duplicates a kept frame, otherwise the frame is kept and
+        # None is returned
+        kept_count = len(self.frames)
+
+        # Closest kept frames first
+        distances = hammingDistances(frame_hash, self.hashes[:kept_count])
+        candidates = np.flatnonzero(distances <= self.max_distance)
+        for i in candidates[np.argsort(distances[candidates], kind="stable")]:
+            kept_frame_id, kept_bbox_tuples = self.frames[i]
+            if similarBBoxes(bbox_tuples, kept_bbox_tuples, self.min_iou):
+                return kept_frame_id, int(distances[i])
+
+        if kept_count == len(self.hashes):
+            hashes = np.zeros(kept_count + kept_count // 2 + 1, dtype=np.uint64)
+            hashes[:kept_count] = self.hashes
+            self.hashes = hashes
+
+        self.hashes[kept_count] = frame_hash
+        self.frames.append((frame_id, bbox_tuples))
+        return None
+
+def hashThumbnail(image, size=32):
+    # Large frames are first shrunk with a linear resize, area resizing them
+    # straight to the thumbnail size is much slower
+    height, width = image.shape[:2]
+    scale = max(min(width, height) // (4 * size), 1)
+    if scale > 1:
+        image = cv.resize(image, (width // scale, height // scale), interpolation=cv.INTER_LINEAR)
+    return cv.cvtColor(cv.resize(image, (size, size), interpolation=cv.INTER_AREA), cv.COLOR_BGR2GRAY)
+
+def dctMatrix(size):
+    # Orthonormal DCT-II basis, one frequency per row
+    n = np.arange(size)
+    matrix = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+def perceptualHashes(thumbnails):
+    # 64 bits DCT hashes of (n, size, size) grayscale thumbnails, a bit is set
+    # where the 8x8 lowest frequencies are above their median (without DC)
+    matrix = dctMatrix(thumbnails.shape[1])[:8]
+    coefficients = (matrix @ thumbnails.astype(np.float64) @ matrix.T).reshape(len(thumbnails), 64)
+    bits = coefficients > np.median(coefficients[:, 1:], axis=1, keepdims=True)
+    return np.packbits(bits, axis=1).view(">u8")[:, 0].astype(np.uint64)
+
+def hammingDistances(frame_hash, hashes):
+    xor = np.bitwise_xor(np.asarray(hashes, dtype=np.uint64), np.uint64(frame_hash))
+
+    # NumPy 2 counts bits natively, every kept frame of a video is compared
+    bitwise_count = getattr(np, "bitwise_count", None)
+    if bitwise_count is not None:
+        return bitwise_count(xor)
+    return np.unpackbits(xor.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+def bboxesIoU(rects_a, rects_b):
+    # (n, m) intersection over union of x, y, w, h rects
+    a = np.asarray(rects_a, dtype=np.float64).reshape(-1, 4)
+    b = np.asarray(rects_b, dtype=np.float64).reshape(-1, 4)
+
+    w = np.minimum(a[:, None, 0] + a[:, None, 2], b[None, :, 0] + b[None, :, 2]) - np.maximum(a[:, None, 0], b[None, :, 0])
+    h = np.minimum(a[:, None, 1] + a[:, None, 3], b[None, :, 1] + b[None, :, 3]) - np.maximum(a[:, None, 1], b[None, :, 1])
+    intersection = np.clip(w, 0, None) * np.clip(h, 0, None)
+    union = (a[:, 2] * a[:, 3])[:, None] + (b[:, 2] * b[:, 3])[None, :] - intersection
+
+    return intersection / np.maximum(union, 1e-9)
+
+def similarBBoxes(bbox_tuples_a, bbox_tuples_b, min_iou):
+    # Same number of bboxes, each paired with one of the same class
+    # overlapping it by at least min_iou, best overlaps first
+    if len(bbox_tuples_a) != len(bbox_tuples_b):
+        return False
+    if len(bbox_tuples_a) == 0:
+        return True
+
+    ious = bboxesIoU([t[1:5] for t in bbox_tuples_a], [t[1:5] for t in bbox_tuples_b])
+    tags_a = np.array([t[0] for t in bbox_tuples_a])
+    tags_b = np.array([t[0] for t in bbox_tuples_b])
+    ious[tags_a[:, None] != tags_b[None, :]] = -1
+
+    for _ in range(len(bbox_tuples_a)):
+        i, j = np.unravel_index(np.argmax(ious), ious.shape)
+        if ious[i, j] < min_iou:
+            return False
+        ious[i, :] = -1
+        ious[:, j] = -1
+
+    return True
 
 class Label(QLabel):
 
+    # Emitted with the drawn rect in image pixels
     rect_created = Signal(QRect) 
 
+    # Emitted with the id of the clicked bbox, None when there is none
+    bbox_clicked = Signal(object)
+
     def __init__(self):
         super(Label, self).__init__()
-        
-        self.setScaledContents(True)
 
         self.begin, self.destination = QPoint(), QPoint()
 
+        # Base layer, converted once per frame
+        self.frame_pixmap = None
+
+        # Image to widget transform, the frame is scaled and centered
+        self.image_size = QSize()
+        self.scale_x, self.scale_y = 1.0, 1.0
+        self.offset = QPoint()
+
+        # Overlay layer, bboxes as (id, image rect, tag name) and the selected bbox id
+        self.bboxes = []
+        self.selected_id = None
+
+        # Hit testing of the bboxes under the cursor
+        self.bbox_grid = BBoxGrid([])
+        self.hovered_id = None
+        self.setMouseTracking(True)
+
+    def setFrame(self, image, image_size):
+        self.frame_pixmap = QPixmap.fromImage(image)
+
+        self.image_size = image_size
+        self.scale_x = image.width() / image_size.width()
+        self.scale_y = image.height() / image_size.height()
+        self.offset = QPoint((self.width() - image.width()) // 2, (self.height() - image.height()) // 2)
+
+        self.update()
+
+    def toWidgetRect(self, rect):
+        x_left = int(round(rect.left() * self.scale_x)) + self.offset.x()
+        y_top = int(round(rect.top() * self.scale_y)) + self.offset.y()
+        x_right = int(round((rect.left() + rect.width()) * self.scale_x)) + self.offset.x()
+        y_bottom = int(round((rect.top() + rect.height()) * self.scale_y)) + self.offset.y()
+        return QRect(x_left, y_top, x_right - x_left, y_bottom - y_top)
+
+    def toImagePoint(self, point):
+        x = int(round((point.x() - self.offset.x()) / self.scale_x))
+        y = int(round((point.y() - self.offset.y()) / self.scale_y))
+        return QPoint(min(max(x, 0), self.image_size.width()), min(max(y, 0), self.image_size.height()))
+
+    def setBBoxes(self, bbox_tags, selected_id=None):
+        self.bboxes = [(bbox_tag.id, bbox_tag.rect, bbox_tag.tag.name) for bbox_tag in bbox_tags]
+        self.bbox_grid = BBoxGrid([bboxRectTuple(rect) for _, rect, _ in self.bboxes])
+        self.selected_id = selected_id
+        self.hovered_id = None
+        self.update()
+
+    def setSelected(self, selected_id):
+        self.updateBBoxes(self.selected_id, selected_id)
+        self.selected_id = selected_id
+
+    def setHovered(self, hovered_id):
+        if hovered_id != self.hovered_id:
+            self.updateBBoxes(self.hovered_id, hovered_id)
+            self.hovered_id = hovered_id
+
+    def updateBBoxes(self, *bbox_ids):
+        # Only repaint the bboxes whose highlight changes
+        for bbox_id, rect, _ in self.bboxes:
+            if bbox_id is not None and bbox_id in bbox_ids:
+                self.update(bboxDirtyRect(self.toWidgetRect(rect)))
+
+    def bboxAt(self, point):
+        # Topmost bbox under a widget point, None when there is none
+        if self.frame_pixmap is None or not QRect(self.offset, self.frame_pixmap.size()).contains(point):
+            return None
+
+        image_point = self.toImagePoint(point)
+        index = self.bbox_grid.hitTest(image_point.x(), image_point.y())
+        return self.bboxes[index][0] if index is not None else None
+
+    def dragRect(self):
+        if self.begin.isNull() or self.destination.isNull():
+            return None
+        return QRect(self.begin, self.destination)
+
+    @timed("ui.paint")
     def paintEvent(self, event):
-        painter = QPainter(self)
-        painter.drawPixmap(QPoint(), self.pixmap())
+        dirty_rect = event.rect()
 
-        if not self.begin.isNull() and not self.destination.isNull():
-            rect = QRect(self.begin, self.destination)
+        painter = QPainter(self)
+        if self.frame_pixmap is not None:
+            frame_rect = QRect(self.offset, self.frame_pixmap.size()).intersected(dirty_rect)
+            painter.drawPixmap(frame_rect, self.frame_pixmap, frame_rect.translated(-self.offset))
+
+        for bbox_id, rect, name in self.bboxes:
+            widget_rect = self.toWidgetRect(rect)
+            if bboxDirtyRect(widget_rect).intersects(dirty_rect):
+                if bbox_id == self.selected_id:
+                    color = Qt.green
+                elif bbox_id == self.hovered_id:
+                    color = Qt.yellow
+                else:
+                    color = Qt.red
+                drawBBoxLabel(painter, widget_rect, name, color=color)
+
+        rect = self.dragRect()
+        if rect is not None:
             drawBBoxLabel(painter, rect)
 
     def mousePressEvent(self, event):
         if event.buttons() & Qt.LeftButton:
             self.begin = event.pos()
             self.destination = self.begin
-            self.update()
+            self.update(bboxDirtyRect(self.dragRect()))
 
     def mouseMoveEvent(self, event):
         if event.buttons() & Qt.LeftButton:	
+            # Repaint the area of the previous and the new drag rect
+            old_rect = self.dragRect()
             self.destination = event.pos()
-            self.update()
+            dirty_rect = bboxDirtyRect(self.dragRect())
+            if old_rect is not None:
+                dirty_rect = dirty_rect.united(bboxDirtyRect(old_rect))
+            self.update(dirty_rect)
+        else:
+            self.setHovered(self.bboxAt(event.pos()))
+
+    def leaveEvent(self, event):
+        self.setHovered(None)
 
     def mouseReleaseEvent(self, event):
         
-        if (event.button() & Qt.LeftButton) and self.pixmap() != None:
+        if (event.button() & Qt.LeftButton) and self.frame_pixmap is not None:
+
+            # A click without dragging selects the bbox under the cursor
+            drag_size = self.destination - self.begin
+            if abs(drag_size.x()) < 3 and abs(drag_size.y()) < 3:
+                dirty_rect = bboxDirtyRect(self.dragRect())
+                self.begin, self.destination = QPoint(), QPoint()
+                self.update(dirty_rect)
+
+                self.bbox_clicked.emit(self.bboxAt(event.pos()))
+                return
 
-            x_left = min(self.begin.x(), self.destination.x())
-            y_top = min(self.begin.y(), self.destination.y())
-            x_right = max(self.begin.x(), self.destination.x())
-            y_bottom = max(self.begin.y(), self.destination.y())
+            begin = self.toImagePoint(self.begin)
+            destination = self.toImagePoint(self.destination)
+
+            x_left = min(begin.x(), destination.x())
+            y_top = min(begin.y(), destination.y())
+            x_right = max(begin.x(), destination.x())
+            y_bottom = max(begin.y(), destination.y())
 
             rect = QRect(x_left, y_top, abs(x_left-x_right), abs(y_top - y_bottom))
 
             # Reset draw rect
+            dirty_rect = bboxDirtyRect(self.dragRect())
             self.begin, self.destination = QPoint(), QPoint()
+            self.update(dirty_rect)
             
             self.rect_created.emit(rect)
         
+class FrameTimeline(QWidget):
+
+    # Emitted with the frame under the cursor when the strip is clicked
+    frame_clicked = Signal(int)
+
+    def __init__(self):
+        super(FrameTimeline, self).__init__()
+
+        self.setFixedHeight(VideoThumbnails.height + 8)
+        self.setMouseTracking(True)
+
+        self.thumbnails = None
+        self.total_frames = 0
+        self.curr_frame = 0
+
+        # Sorted ids of the frames with bboxes
+        self.annotated_frames = np.zeros(0, dtype=np.int64)
+
+        # Thumbnails strip, rendered again on resize or when thumbnails change
+        self.strip_pixmap = None
+
+        # Bigger preview shown while hovering the strip
+        self.hover_label = QLabel(self, Qt.ToolTip)
+
+    def setThumbnails(self, thumbnails):
+        self.thumbnails = thumbnails
+        self.strip_pixmap = None
+        self.update()
+
+    def setTotalFrames(self, total_frames):
+        self.total_frames = total_frames
+        self.strip_pixmap = None
+        self.update()
+
+    def setCurrentFrame(self, frame_id):
+        if frame_id != self.curr_frame:
+            old_x = self.frameToX(self.curr_frame)
+            self.curr_frame = frame_id
+            self.update(QRect(old_x - 1, 0, 3, self.height()))
+            self.update(QRect(self.frameToX(frame_id) - 1, 0, 3, self.height()))
+
+    def setAnnotatedFrames(self, frame_ids):
+        self.annotated_frames = np.asarray(frame_ids, dtype=np.int64)
+        self.update()
+
+    def setFrameAnnotated(self, frame_id, annotated):
+        i = np.searchsorted(self.annotated_frames, frame_id)
+        found = i < len(self.annotated_frames) and self.annotated_frames[i] == frame_id
+        if annotated and not found:
+            self.annotated_frames = np.insert(self.annotated_frames, i, frame_id)
+        elif not annotated and found:
+            self.annotated_frames = np.delete(self.annotated_frames, i)
+        else:
+            return
+        self.update(QRect(self.frameToX(frame_id) - 1, 0, 3, self.height()))
+
+    def frameToX(self, frame_id):
+        return int(frame_id * self.width() / max(self.total_frames, 1))
+
+    def xToFrame(self, x):
+        frame_id = int(x * self.total_frames / max(self.width(), 1))
+        return min(max(frame_id, 0), max(self.total_frames - 1, 0))
+
+    def renderStrip(self):
+        self.strip_pixmap = QPixmap(self.size())
+        self.strip_pixmap.fill(Qt.black)
+
+        thumbnails = self.thumbnails
+        if thumbnails is None or len(thumbnails) == 0 or self.total_frames == 0:
+            return
+
+        # Tiles side by side, each one shows the thumbnail at its center frame
+        thumb_height, thumb_width = thumbnails.images.shape[1:3]
+        tiles_count = max(self.width() // thumb_width, 1)
+        tile_width = self.width() / tiles_count
+        top = (self.height() - thumb_height) // 2
+
+        painter = QPainter(self.strip_pixmap)
+        for tile in range(tiles_count):
+            index = thumbnails.nearestIndex(self.xToFrame(int((tile + 0.5) * tile_width)))
+            painter.drawImage(QPoint(int(tile * tile_width), top), thumbnails.toQImage(index))
+        painter.end()
+
+    def paintEvent(self, event):
+        if self.strip_pixmap is None or self.strip_pixmap.size() != self.size():
+            self.renderStrip()
+
+        painter = QPainter(self)
+        painter.drawPixmap(event.rect(), self.strip_pixmap, event.rect())
+
+        # One mark per pixel column with annotated frames
+        if len(self.annotated_frames) > 0 and self.total_frames > 0:
+            painter.setPen(QPen(Qt.green, 1))
+            xs = np.unique(self.annotated_frames * self.width() // self.total_frames)
+            for x in xs[(xs >= event.rect().left()) & (xs <= event.rect().right())]:
+                painter.drawLine(int(x), self.height() - 6, int(x), self.height())
+
+        # Current frame
+        painter.setPen(QPen(Qt.red, 1))
+        x = self.frameToX(self.curr_frame)
+        painter.drawLine(x, 0, x, self.height())
+
+    def mouseMoveEvent(self, event):
+        if self.thumbnails is None or len(self.thumbnails) == 0 or self.total_frames == 0:
+            return
+
+        # Preview from the thumbnails cache, the decoder is not used
+        frame_id = self.xToFrame(event.pos().x())
+        index = self.thumbnails.nearestIndex(frame_id)
+        image = self.thumbnails.toQImage(index)
+        pixmap = QPixmap.fromImage(image.scaled(image.width() * 3, image.height() * 3, Qt.KeepAspectRatio, Qt.SmoothTransformation))
+
+        painter = QPainter(pixmap)
+        painter.setPen(QPen(Qt.green, 3))
+        painter.drawText(QPoint(4, 16), str(frame_id))
+        painter.end()
+
+        self.hover_label.setPixmap(pixmap)
+        self.hover_label.resize(pixmap.size())
+        self.hover_label.move(self.mapToGlobal(QPoint(event.pos().x() - pixmap.width() // 2, -pixmap.height() - 4)))
+        self.hover_label.show()
+
+    def leaveEvent(self, event):
+        self.hover_label.hide()
+
+    def mousePressEvent(self, event):
+        if self.total_frames > 0:
+            self.frame_clicked.emit(self.xToFrame(event.pos().x()))
+
+class BBoxGrid():
+
+    def __init__(self, rects):
+        # Uniform grid over the image, each cell lists the indexes of the
+        # rects (x, y, w, h) overlapping it in drawing order
+        self.rects = rects
+        self.cells = {}
+
+        if len(rects) == 0:
+            self.cell_size = 1
+            return
+
+        # Cells about the size of the bboxes, so each one spans a few cells
+        array = np.array(rects, dtype=np.int64)
+        self.cell_size = max(32, int(np.median(np.maximum(array[:, 2], array[:, 3]))))
+
+        first_cells = array[:, :2] // self.cell_size
+        last_cells = (array[:, :2] + array[:, 2:]) // self.cell_size
+        for index, (cx0, cy0, cx1, cy1) in enumerate(np.hstack((first_cells, last_cells)).tolist()):
+            for cx in range(cx0, cx1 + 1):
+                for cy in range(cy0, cy1 + 1):
+                    self.cells.setdefault((cx, cy), []).append(index)
+
+    def hitTest(self, x, y):
+        # Index of the last drawn rect containing (x, y), None when there is none
+        for index in reversed(self.cells.get((x // self.cell_size, y // self.cell_size), ())):
+            rx, ry, rw, rh = self.rects[index]
+            if rx <= x <= rx + rw and ry <= y <= ry + rh:
+                return index
+        return None
+
 class Tag():
 
     def __init__(self, id=0, name="Undefined"):
@@ -568,9 +3005,12 @@ class Tag():
         return f"{self.id},{self.name}"
 
 class BBoxTag():
+    __slots__ = ("id", "rect", "tag", "frame_id", "file_name")
+
     def __init__(self):
 
         # Bounding Box Label props
+        self.id = -1
         self.rect = QRect()
         self.tag = Tag()
         self.frame_id = -1
@@ -603,99 +3043,1052 @@ class BBoxTag():
 
 class TagDataset():
 
-    def __init__(self):
-        self.bbox_tags = []
+    # Column storage of bboxes, tag and file are indexes in the interned tables
+    column_dtypes = {
+        "x": np.int32,
+        "y": np.int32,
+        "w": np.int32,
+        "h": np.int32,
+        "tag": np.int32,
+        "frame_id": np.int32,
+        "file": np.int32,
+        "id": np.int64,
+        "alive": np.bool_
+    }
+
+    headers = ["x", "y", "w", "h", "tag_id", "tag_name", "frame_id", "file_name"]
+
+    def __init__(self, capacity=1024):
+        self.columns = {name: np.zeros(capacity, dtype=dtype) for name, dtype in self.column_dtypes.items()}
+
+        # Used rows, deleted rows are kept until compaction
+        self.size = 0
+        self.count = 0
+
+        # Interned tables
+        self.file_names = []
+        self.file_indexes = {}
+        self.tags = []
+        self.tag_indexes = {}
+
+        # Row of each bbox id, -1 for the ids without one
+        self.id_rows = np.full(capacity, -1, dtype=np.int32)
+        self.next_bbox_id = 0
+
+        # Rows by frame key (file << 32 | frame_id) as sorted unique keys,
+        # offsets into the rows sorted by key and those rows. It covers the
+        # first indexed_size rows, rows added later and indexed rows moved to
+        # another frame are looked up apart until it is built again
+        self.index_keys = np.zeros(0, dtype=np.int64)
+        self.index_offsets = np.zeros(1, dtype=np.int64)
+        self.index_rows = np.zeros(0, dtype=np.int32)
+        self.indexed_size = 0
+        self.moved_rows = {}
+        self.moved_count = 0
+
+        # Journal of changes, set by openJournal
+        self.journal = None
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        # The journal is kept, the empty dataset is snapshotted right away so
+        # that later changes are not replayed over the bboxes dropped here
+        journal = self.journal
+        self.__init__()
+        self.journal = journal
+
+        if journal is not None:
+            journal.snapshot(self, wait=True)
+
+    def internFile(self, file_name):
+        file_index = self.file_indexes.get(file_name)
+        if file_index is None:
+            file_index = len(self.file_names)
+            self.file_names.append(file_name)
+            self.file_indexes[file_name] = file_index
+        return file_index
+
+    def internTag(self, tag):
+        key = (int(tag.id), tag.name)
+        tag_index = self.tag_indexes.get(key)
+        if tag_index is None:
+            tag_index = len(self.tags)
+            self.tags.append(Tag(key[0], key[1]))
+            self.tag_indexes[key] = tag_index
+        return tag_index
+
+    def reserve(self, capacity):
+        curr_capacity = len(self.columns["id"])
+        if capacity <= curr_capacity:
+            return
 
-        self.headers = ["x", "y", "w", "h", "tag_id", "tag_name", "frame_id", "file_name"]
+        # Grown by a quarter, large datasets keep little unused room
+        new_capacity = max(capacity, curr_capacity + curr_capacity // 4)
+        for name, column in self.columns.items():
+            new_column = np.zeros(new_capacity, dtype=column.dtype)
+            new_column[:self.size] = column[:self.size]
+            self.columns[name] = new_column
+
+    def compact(self):
+        alive = self.columns["alive"][:self.size]
+        for name, column in self.columns.items():
+            self.columns[name] = column[:self.size][alive]
+
+        self.size = self.count
+        self.reserve(max(self.size, 1024))
+
+        # Rows are renumbered
+        self.id_rows[:] = -1
+        self.setIdRows(self.columns["id"][:self.size], np.arange(self.size))
+        self.dropIndex()
+
+    def writeRow(self, row, bbox_tag):
+        rect = bbox_tag.rect
+        self.columns["x"][row] = rect.left()
+        self.columns["y"][row] = rect.top()
+        self.columns["w"][row] = rect.width()
+        self.columns["h"][row] = rect.height()
+        self.columns["tag"][row] = self.internTag(bbox_tag.tag)
+        self.columns["frame_id"][row] = bbox_tag.frame_id
+        self.columns["file"][row] = self.internFile(bbox_tag.file_name)
+
+    def readRow(self, row):
+        columns = self.columns
 
-    def addTag(self, bbox_tag):
-        self.bbox_tags.append(bbox_tag)
+        bbox_tag = BBoxTag()
+        bbox_tag.setValues(
+            QRect(int(columns["x"][row]), int(columns["y"][row]), int(columns["w"][row]), int(columns["h"][row])),
+            self.tags[columns["tag"][row]],
+            int(columns["frame_id"][row]),
+            self.file_names[columns["file"][row]]
+            )
+        bbox_tag.id = int(columns["id"][row])
 
-    def saveDataset(self, save_path):
-        with open(save_path, 'w', encoding='UTF8', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(self.headers)
+        return bbox_tag
 
-            for bbox_tag in self.bbox_tags:
-                row_data = bbox_tag.getValues()
-                writer.writerow(row_data)
+    def frameKeys(self, rows):
+        return (self.columns["file"][rows].astype(np.int64) << 32) | self.columns["frame_id"][rows].astype(np.int64)
 
-    def loadDataset(self, file_path):
-        print("Load Dataset")
+    def rowOf(self, bbox_id):
+        if bbox_id is None or bbox_id < 0 or bbox_id >= len(self.id_rows):
+            return None
+        row = int(self.id_rows[bbox_id])
+        return row if row >= 0 else None
 
-        print("Before: ", len(self.bbox_tags))
-        df = pd.read_csv(file_path)
-        for _, row in df.iterrows():
-            rect = QRect(row["x"], row["y"], row["w"], row["h"])
-            tag = Tag(row["tag_id"], row["tag_name"])
-            frame_id = row["frame_id"]
-            filename = row["file_name"]
+    def setIdRows(self, ids, rows):
+        if len(ids) == 0:
+            return
 
-            bbox_tag = BBoxTag()
-            bbox_tag.setValues(rect, tag, frame_id, filename)
+        capacity = int(ids.max()) + 1
+        if capacity > len(self.id_rows):
+            id_rows = np.full(max(capacity, len(self.id_rows) + len(self.id_rows) // 4), -1, dtype=np.int32)
+            id_rows[:len(self.id_rows)] = self.id_rows
+            self.id_rows = id_rows
 
-            self.bbox_tags.append(bbox_tag)
-        
-        print("After: ", len(self.bbox_tags))
+        self.id_rows[ids] = rows
+
+    def dropIndex(self):
+        self.index_keys = np.zeros(0, dtype=np.int64)
+        self.index_offsets = np.zeros(1, dtype=np.int64)
+        self.index_rows = np.zeros(0, dtype=np.int32)
+        self.indexed_size = 0
+        self.moved_rows = {}
+        self.moved_count = 0
+
+    def buildIndex(self):
+        # Rows of a frame keep their order
+        rows = np.flatnonzero(self.columns["alive"][:self.size]).astype(np.int32)
+        keys = self.frameKeys(rows)
+        order = np.argsort(keys, kind="stable")
+
+        self.index_rows = rows[order]
+        self.index_keys, starts = np.unique(keys[order], return_index=True)
+        self.index_offsets = np.append(starts, len(rows)).astype(np.int64)
+        self.indexed_size = self.size
+        self.moved_rows = {}
+        self.moved_count = 0
+
+    def frameRows(self, file_index, frame_id):
+        # Built again once the rows outside the index are too many to scan
+        if self.size - self.indexed_size + self.moved_count > max(4096, self.indexed_size // 64):
+            self.buildIndex()
+
+        key = (file_index << 32) | frame_id
+        parts = [np.array(self.moved_rows.get(key, []), dtype=np.int32)]
+
+        i = int(np.searchsorted(self.index_keys, key))
+        if i < len(self.index_keys) and self.index_keys[i] == key:
+            parts.append(self.index_rows[self.index_offsets[i]:self.index_offsets[i + 1]])
+
+        columns = self.columns
+        tail = (columns["file"][self.indexed_size:self.size] == file_index) & (columns["frame_id"][self.indexed_size:self.size] == frame_id)
+        parts.append((np.flatnonzero(tail) + self.indexed_size).astype(np.int32))
+
+        # Deleted rows and rows moved to another frame are still listed
+        rows = np.unique(np.concatenate(parts))
+        return rows[columns["alive"][rows] & (columns["file"][rows] == file_index) & (columns["frame_id"][rows] == frame_id)]
+
+    def addTag(self, bbox_tag, bbox_id=None):
+        if bbox_id is None:
+            bbox_id = self.next_bbox_id
+        bbox_tag.id = bbox_id
+        self.next_bbox_id = max(self.next_bbox_id, bbox_id + 1)
+
+        self.reserve(self.size + 1)
+        row = self.size
+        self.size += 1
+        self.count += 1
+
+        self.writeRow(row, bbox_tag)
+        self.columns["id"][row] = bbox_tag.id
+        self.columns["alive"][row] = True
+
+        self.setIdRows(np.array([bbox_tag.id]), row)
+
+        if self.journal is not None:
+            self.journal.record({"op": "add", "id": bbox_tag.id, "values": self.readRow(row).getValues()})
+
+    def getBBoxTag(self, bbox_id):
+        row = self.rowOf(bbox_id)
+        if row is None:
+            return None
+        return self.readRow(row)
+
+    def getColumns(self):
+        alive = self.columns["alive"][:self.size]
+        columns = {name: column[:self.size][alive] for name, column in self.columns.items() if name != "alive"}
+
+        # Resolve interned tag ids
+        tag_ids = np.array([tag.id for tag in self.tags], dtype=np.int32)
+        columns["tag_id"] = tag_ids[columns["tag"]] if len(tag_ids) > 0 else columns["tag"]
+
+        return columns
+
+    def getBBoxesDict(self, lock=None):
+        # The columns copy is taken holding lock and grouped without it
+        with lock if lock is not None else contextlib.nullcontext():
+            columns = self.getColumns()
+            file_names = list(self.file_names)
+
+        return groupBBoxes(columns["file"], file_names, columns["frame_id"], columns["tag_id"], columns["x"], columns["y"], columns["w"], columns["h"])
+
+    def getFrameIds(self, file_name):
+        file_index = self.file_indexes.get(file_name)
+        if file_index is None:
+            return np.zeros(0, dtype=np.int32)
+
+        columns = self.columns
+        mask = columns["alive"][:self.size] & (columns["file"][:self.size] == file_index)
+
+        return np.unique(columns["frame_id"][:self.size][mask])
+
+    def getDataFrame(self, with_ids=False):
+        columns = self.getColumns()
+
+        tag_names = np.array([tag.name for tag in self.tags], dtype=object)
+        file_names = np.array(self.file_names, dtype=object)
+
+        df = pd.DataFrame({
+            "x": columns["x"],
+            "y": columns["y"],
+            "w": columns["w"],
+            "h": columns["h"],
+            "tag_id": columns["tag_id"],
+            "tag_name": tag_names[columns["tag"]] if len(tag_names) > 0 else [],
+            "frame_id": columns["frame_id"],
+            "file_name": file_names[columns["file"]] if len(file_names) > 0 else []
+        }, columns=self.headers)
+
+        if with_ids:
+            df["id"] = columns["id"]
+
+        return df
+
+    @timed("dataset.save")
+    def saveDataset(self, save_path, lock=None, progress_callback=None, chunk_size=100000):
+        # The dataset copy is taken holding lock and written without it,
+        # progress_callback(written_rows, total_rows) is called after each chunk
+        with lock if lock is not None else contextlib.nullcontext():
+            if isBinaryDatasetPath(save_path):
+                columns, tags, file_names = self.getColumns(), list(self.tags), list(self.file_names)
+            else:
+                df = self.getDataFrame()
 
-    def getFrameBBoxs(self, file_name, frame_id):
-        
-        bbox_values = [bbox_tag.getValues() for bbox_tag in self.bbox_tags]
+        if isBinaryDatasetPath(save_path):
+            writeBinaryDataset(save_path, columns, tags, file_names)
+        else:
+            writeDatasetCSV(save_path, (df.iloc[start:start + chunk_size] for start in range(0, len(df), chunk_size)), len(df), progress_callback)
+
+    def loadBinaryDataset(self, file_path):
+        count, columns, tags, file_names = readBinaryDataset(file_path)
+        if count == 0:
+            return
+
+        if self.size > 0:
+            tag_ids = np.array([tag.id for tag in tags], dtype=np.int32)
+            tag_names = np.array([tag.name for tag in tags], dtype=object)
+            file_names = np.array(file_names, dtype=object)
+            self.appendColumns(columns["x"], columns["y"], columns["w"], columns["h"],
+                tag_ids[columns["tag"]], tag_names[columns["tag"]], columns["frame_id"], file_names[columns["file"]])
+            return
 
-        df = pd.DataFrame(data=bbox_values, columns=self.headers)
+        # Empty dataset uses the mapped columns as they are, they are copied
+        # when they grow or on write
+        self.columns = dict(columns)
+        self.columns["alive"] = np.ones(count, dtype=np.bool_)
+        self.size = count
+        self.count = count
 
-        df_filtered = df.query("file_name == @file_name and frame_id == @frame_id")
+        self.file_names = list(file_names)
+        self.file_indexes = {file_name: i for i, file_name in enumerate(self.file_names)}
+        self.tags = list(tags)
+        self.tag_indexes = {(tag.id, tag.name): i for i, tag in enumerate(self.tags)}
 
-        bbox_tags = []
-        for _, row in df_filtered.iterrows():
-            rect = QRect(row["x"], row["y"], row["w"], row["h"])
-            tag = Tag(row["tag_id"], row["tag_name"])
-            frame_id = row["frame_id"]
-            file_name = row["file_name"]
+        self.next_bbox_id = int(columns["id"].max()) + 1
+        self.setIdRows(columns["id"], np.arange(count))
 
-            bbox_tag = BBoxTag()
-            bbox_tag.setValues(rect, tag, frame_id, file_name)
+    def appendColumns(self, x, y, w, h, tag_ids, tag_names, frame_ids, file_names, ids=None):
+        n = len(x)
+        if n == 0:
+            return np.zeros(0, dtype=np.int64)
 
-            bbox_tags.append(bbox_tag)
-        
-        return bbox_tags
+        # Intern files and tags once per unique value
+        file_codes, file_uniques = pd.factorize(np.asarray(file_names, dtype=object))
+        file_map = np.array([self.internFile(file_name) for file_name in file_uniques], dtype=np.int32)
+
+        tag_codes, tag_uniques = pd.MultiIndex.from_arrays([np.asarray(tag_ids), np.asarray(tag_names, dtype=object)]).factorize()
+        tag_map = np.array([self.internTag(Tag(tag_id, tag_name)) for tag_id, tag_name in tag_uniques], dtype=np.int32)
+
+        if ids is None:
+            ids = np.arange(self.next_bbox_id, self.next_bbox_id + n, dtype=np.int64)
+            self.next_bbox_id += n
+        else:
+            ids = np.asarray(ids, dtype=np.int64)
+            self.next_bbox_id = max(self.next_bbox_id, int(ids.max()) + 1)
+
+        self.reserve(self.size + n)
+        start, end = self.size, self.size + n
+        columns = self.columns
+        columns["x"][start:end] = x
+        columns["y"][start:end] = y
+        columns["w"][start:end] = w
+        columns["h"][start:end] = h
+        columns["tag"][start:end] = tag_map[tag_codes]
+        columns["frame_id"][start:end] = frame_ids
+        columns["file"][start:end] = file_map[file_codes]
+        columns["id"][start:end] = ids
+        columns["alive"][start:end] = True
+
+        self.size = end
+        self.count += n
+
+        # The frame index is built on the next lookup
+        self.setIdRows(ids, np.arange(start, end))
+
+        return ids
+
+    def appendDataFrame(self, df):
+        return self.appendColumns(*getDataFrameColumns(df))
+
+    @timed("dataset.load")
+    def loadDataset(self, file_path, chunk_size=None, progress_callback=None, lock=None):
+        # With chunk_size the file is read chunk_size rows at a time and
+        # progress_callback(read_bytes, total_bytes) is called after each chunk.
+        # lock is held while each chunk is added, not while it is read
+        lock = lock if lock is not None else contextlib.nullcontext()
+
+        print("Load Dataset")
+
+        print("Before: ", len(self))
+
+        try:
+            if isBinaryDatasetPath(file_path):
+                with lock:
+                    self.loadBinaryDataset(file_path)
+            else:
+                for df in readDatasetCSV(file_path, chunk_size, progress_callback):
+                    with lock:
+                        self.appendDataFrame(df)
+        finally:
+            print("After: ", len(self))
+
+            # Bulk loads are not journaled, they go straight to a snapshot,
+            # also the chunks added before an error or a cancel
+            if self.journal is not None:
+                with lock:
+                    self.journal.recordBulkChange(self)
+
+    @timed("dataset.get_frame_bboxs")
+    def getFrameBBoxs(self, file_name, frame_id):
+        file_index = self.file_indexes.get(file_name)
+        if file_index is None:
+            return []
+
+        return [self.readRow(row) for row in self.frameRows(file_index, frame_id).tolist()]
 
     def deleteBBoxTag(self, target_tag):
-        if target_tag is None:
+        row = self.rowOf(target_tag.id) if target_tag is not None else None
+        if row is None:
             showMessage("The tag cannot be deleted, it does not exist")
             return
 
-        # Get index to delete
-        index_to_delete = -1
-        for i in range(len(self.bbox_tags)):
-            bbox_tag = self.bbox_tags[i]
-            if bbox_tag == target_tag:
-                index_to_delete = i
-                break
-        
-        if index_to_delete != -1: 
-            del self.bbox_tags[index_to_delete]
+        self.id_rows[target_tag.id] = -1
+        self.columns["alive"][row] = False
+        self.count -= 1
+
+        if self.journal is not None:
+            self.journal.record({"op": "delete", "id": target_tag.id})
+
+        # Drop deleted rows once they are the majority
+        if self.size > 1024 and self.count < self.size // 2:
+            self.compact()
+
+    def updateBBoxTag(self, target_tag, new_tag):
+        row = self.rowOf(target_tag.id) if target_tag is not None else None
+        if row is None:
+            showMessage("The tag cannot be updated, it does not exist")
+            return
+
+        # Keep the id of the replaced bbox
+        new_tag.id = target_tag.id
+
+        old_key = int(self.frameKeys(row))
+        self.writeRow(row, new_tag)
+
+        key = int(self.frameKeys(row))
+        if row < self.indexed_size and key != old_key:
+            self.moved_rows.setdefault(key, []).append(row)
+            self.moved_count += 1
+
+        if self.journal is not None:
+            self.journal.record({"op": "update", "id": new_tag.id, "values": self.readRow(row).getValues()})
+
+    def openJournal(self, snapshot_path):
+        # Restore the snapshot and the changes journaled after it, then
+        # journal every change until the next snapshot. Returns False and
+        # leaves the dataset unjournaled when another process holds the journal
+        self.journal = None
+
+        journal = DatasetJournal(snapshot_path)
+        if not journal.lock():
+            return False
+
+        if os.path.exists(snapshot_path):
+            self.appendDataFrame(pd.read_csv(snapshot_path, keep_default_na=False, dtype={"tag_name": str, "file_name": str}))
+
+        replayed_count = journal.replay(self)
+        print("Restored {} bboxes, {} journaled changes".format(len(self), replayed_count))
+
+        journal.open()
+        self.journal = journal
+        return True
+
+    def applyJournalOp(self, op):
+        bbox_id = op["id"]
+
+        if op["op"] == "delete":
+            if self.rowOf(bbox_id) is not None:
+                self.deleteBBoxTag(self.getBBoxTag(bbox_id))
+            return
+
+        x, y, w, h, tag_id, tag_name, frame_id, file_name = op["values"]
+        bbox_tag = BBoxTag()
+        bbox_tag.setValues(QRect(x, y, w, h), Tag(tag_id, tag_name), frame_id, file_name)
+
+        # Ops already in the snapshot are applied again without effect
+        if self.rowOf(bbox_id) is not None:
+            self.updateBBoxTag(self.getBBoxTag(bbox_id), bbox_tag)
         else:
+            self.addTag(bbox_tag, bbox_id)
+        
+class DatasetJournal():
+
+    # Append-only log of dataset changes next to its snapshot file. A snapshot
+    # moves the log aside to "<journal>.old" and deletes it once written.
+    # "<journal>.lock" is locked while a process uses them, the OS drops the
+    # lock when the process dies so a crash does not leave them locked
+
+    def __init__(self, snapshot_path):
+        self.snapshot_path = snapshot_path
+        self.journal_path = snapshot_path + ".journal"
+        self.old_journal_path = self.journal_path + ".old"
+        self.lock_path = self.journal_path + ".lock"
+
+        self.file = None
+        self.lock_file = None
+        self.changes_count = 0
+        self.snapshot_thread = None
+
+    def lock(self):
+        directory = os.path.dirname(self.snapshot_path)
+        if directory != "":
+            os.makedirs(directory, exist_ok=True)
+
+        lock_file = open(self.lock_path, "a+b")
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            lock_file.close()
+            return False
+
+        self.lock_file = lock_file
+        return True
+
+    def open(self):
+        self.file = open(self.journal_path, "a", encoding="UTF8")
+
+    def close(self):
+        self.waitSnapshot()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+        # Closing the file releases its lock
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def record(self, op):
+        self.file.write(json.dumps(op) + "\n")
+        self.file.flush()
+        self.changes_count += 1
+
+    def recordBulkChange(self, tags_dataset):
+        # Written by the next snapshot if one is already running
+        self.changes_count += 1
+        self.snapshot(tags_dataset)
+
+    def replay(self, tags_dataset):
+        replayed_count = 0
+        for path in (self.old_journal_path, self.journal_path):
+            if not os.path.exists(path):
+                continue
+
+            with open(path, encoding="UTF8") as f:
+                for line in f:
+                    try:
+                        op = json.loads(line)
+                    except ValueError:
+                        # Line cut by a crash
+                        break
+                    tags_dataset.applyJournalOp(op)
+                    replayed_count += 1
+
+        self.changes_count = replayed_count
+        return replayed_count
+
+    def isSnapshotRunning(self):
+        return self.snapshot_thread is not None and self.snapshot_thread.is_alive()
+
+    def waitSnapshot(self):
+        if self.snapshot_thread is not None:
+            self.snapshot_thread.join()
+            self.snapshot_thread = None
+
+    def snapshot(self, tags_dataset, wait=False):
+        if self.isSnapshotRunning():
+            if not wait:
+                return False
+            self.waitSnapshot()
+
+        # Dataset copy is taken now, it is written in background
+        df = tags_dataset.getDataFrame(with_ids=True)
+
+        self.file.close()
+        if os.path.exists(self.old_journal_path):
+            # Previous snapshot failed, its changes are still pending
+            with open(self.journal_path, encoding="UTF8") as f, open(self.old_journal_path, "a", encoding="UTF8") as old_f:
+                shutil.copyfileobj(f, old_f)
+            os.remove(self.journal_path)
+        elif os.path.exists(self.journal_path):
+            os.replace(self.journal_path, self.old_journal_path)
+        self.open()
+        self.changes_count = 0
+
+        self.snapshot_thread = threading.Thread(target=self.writeSnapshot, args=(df,), daemon=True)
+        self.snapshot_thread.start()
+        if wait:
+            self.waitSnapshot()
+
+        return True
+
+    def writeSnapshot(self, df):
+        tmp_path = self.snapshot_path + ".tmp"
+        try:
+            df.to_csv(tmp_path, index=False, encoding='UTF8')
+            os.replace(tmp_path, self.snapshot_path)
+            os.remove(self.old_journal_path)
+        except OSError as error:
+            print(error)
+
+class SQLiteTagDataset():
+
+    # TagDataset stored in a SQLite database, bboxes are read and written
+    # straight from it so memory use does not depend on the dataset size
+
+    headers = TagDataset.headers
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.db = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+            CREATE TABLE IF NOT EXISTS tags (id INTEGER PRIMARY KEY, tag_id INTEGER NOT NULL, name TEXT NOT NULL, UNIQUE (tag_id, name));
+            CREATE TABLE IF NOT EXISTS bboxes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                x INTEGER NOT NULL,
+                y INTEGER NOT NULL,
+                w INTEGER NOT NULL,
+                h INTEGER NOT NULL,
+                tag INTEGER NOT NULL REFERENCES tags (id),
+                frame_id INTEGER NOT NULL,
+                file INTEGER NOT NULL REFERENCES files (id)
+            );
+            CREATE INDEX IF NOT EXISTS bboxes_frame ON bboxes (file, frame_id);
+            CREATE INDEX IF NOT EXISTS bboxes_tag ON bboxes (tag);
+        """)
+
+        # Interned tables are small, they are kept in memory
+        self.file_names = {}
+        self.file_indexes = {}
+        for file_index, name in self.db.execute("SELECT id, name FROM files"):
+            self.file_names[file_index] = name
+            self.file_indexes[name] = file_index
+
+        self.tags_by_index = {}
+        self.tag_indexes = {}
+        for tag_index, tag_id, name in self.db.execute("SELECT id, tag_id, name FROM tags"):
+            self.tags_by_index[tag_index] = Tag(tag_id, name)
+            self.tag_indexes[(tag_id, name)] = tag_index
+
+        # Counted on first use
+        self.count = None
+
+        # Changes are durable in the database, there is no journal
+        self.journal = None
+
+    @property
+    def tags(self):
+        return list(self.tags_by_index.values())
+
+    def __len__(self):
+        if self.count is None:
+            self.count = self.db.execute("SELECT COUNT(*) FROM bboxes").fetchone()[0]
+        return self.count
+
+    def close(self):
+        self.db.close()
+
+    def clear(self):
+        self.db.execute("DELETE FROM bboxes")
+        self.count = 0
+
+    def internFile(self, file_name):
+        file_index = self.file_indexes.get(file_name)
+        if file_index is None:
+            file_index = self.db.execute("INSERT INTO files (name) VALUES (?)", (file_name,)).lastrowid
+            self.file_names[file_index] = file_name
+            self.file_indexes[file_name] = file_index
+        return file_index
+
+    def internTag(self, tag):
+        key = (int(tag.id), tag.name)
+        tag_index = self.tag_indexes.get(key)
+        if tag_index is None:
+            tag_index = self.db.execute("INSERT INTO tags (tag_id, name) VALUES (?, ?)", key).lastrowid
+            self.tags_by_index[tag_index] = Tag(key[0], key[1])
+            self.tag_indexes[key] = tag_index
+        return tag_index
+
+    def rowValues(self, bbox_tag):
+        rect = bbox_tag.rect
+        return (rect.left(), rect.top(), rect.width(), rect.height(), self.internTag(bbox_tag.tag), int(bbox_tag.frame_id), self.internFile(bbox_tag.file_name))
+
+    def readRow(self, row):
+        bbox_id, x, y, w, h, tag_index, frame_id, file_index = row
+
+        bbox_tag = BBoxTag()
+        bbox_tag.setValues(QRect(x, y, w, h), self.tags_by_index[tag_index], frame_id, self.file_names[file_index])
+        bbox_tag.id = bbox_id
+
+        return bbox_tag
+
+    def addTag(self, bbox_tag, bbox_id=None):
+        cursor = self.db.execute("INSERT INTO bboxes (id, x, y, w, h, tag, frame_id, file) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (bbox_id,) + self.rowValues(bbox_tag))
+        bbox_tag.id = cursor.lastrowid
+
+        if self.count is not None:
+            self.count += 1
+
+    def getBBoxTag(self, bbox_id):
+        row = self.db.execute("SELECT id, x, y, w, h, tag, frame_id, file FROM bboxes WHERE id = ?", (bbox_id,)).fetchone()
+        if row is None:
+            return None
+        return self.readRow(row)
+
+    @timed("dataset.get_frame_bboxs")
+    def getFrameBBoxs(self, file_name, frame_id):
+        file_index = self.file_indexes.get(file_name)
+        if file_index is None:
+            return []
+
+        rows = self.db.execute("SELECT id, x, y, w, h, tag, frame_id, file FROM bboxes WHERE file = ? AND frame_id = ? ORDER BY id", (file_index, int(frame_id)))
+        return [self.readRow(row) for row in rows]
+
+    def getFrameIds(self, file_name):
+        file_index = self.file_indexes.get(file_name)
+        if file_index is None:
+            return np.zeros(0, dtype=np.int32)
+
+        rows = self.db.execute("SELECT DISTINCT frame_id FROM bboxes WHERE file = ? ORDER BY frame_id", (file_index,)).fetchall()
+        return np.array([row[0] for row in rows], dtype=np.int32)
+
+    def deleteBBoxTag(self, target_tag):
+        if target_tag is None or self.db.execute("DELETE FROM bboxes WHERE id = ?", (target_tag.id,)).rowcount == 0:
             showMessage("The tag cannot be deleted, it does not exist")
+            return
+
+        if self.count is not None:
+            self.count -= 1
 
     def updateBBoxTag(self, target_tag, new_tag):
         if target_tag is None:
             showMessage("The tag cannot be updated, it does not exist")
             return
 
-        # Get index to delete
-        index_to_change = -1
-        for i in range(len(self.bbox_tags)):
-            bbox_tag = self.bbox_tags[i]
-            if bbox_tag == target_tag:
-                index_to_change = i
-                break
-        
-        if index_to_change != -1: 
-            self.bbox_tags[index_to_change] = new_tag
-        else:
+        cursor = self.db.execute("UPDATE bboxes SET x = ?, y = ?, w = ?, h = ?, tag = ?, frame_id = ?, file = ? WHERE id = ?", self.rowValues(new_tag) + (target_tag.id,))
+        if cursor.rowcount == 0:
             showMessage("The tag cannot be updated, it does not exist")
-        
+            return
+
+        # Keep the id of the replaced bbox
+        new_tag.id = target_tag.id
+
+    def appendColumns(self, x, y, w, h, tag_ids, tag_names, frame_ids, file_names, ids=None):
+        n = len(x)
+        if n == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        # Intern files and tags once per unique value
+        file_codes, file_uniques = pd.factorize(np.asarray(file_names, dtype=object))
+        file_map = np.array([self.internFile(file_name) for file_name in file_uniques], dtype=np.int64)
+
+        tag_codes, tag_uniques = pd.MultiIndex.from_arrays([np.asarray(tag_ids), np.asarray(tag_names, dtype=object)]).factorize()
+        tag_map = np.array([self.internTag(Tag(tag_id, tag_name)) for tag_id, tag_name in tag_uniques], dtype=np.int64)
+
+        if ids is None:
+            # Ids are never reused, even after deleting the last bboxes
+            row = self.db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'bboxes'").fetchone()
+            first_id = row[0] + 1 if row is not None else 1
+            ids = np.arange(first_id, first_id + n, dtype=np.int64)
+
+        rows = zip(
+            np.asarray(ids, dtype=np.int64).tolist(),
+            np.asarray(x, dtype=np.int64).tolist(),
+            np.asarray(y, dtype=np.int64).tolist(),
+            np.asarray(w, dtype=np.int64).tolist(),
+            np.asarray(h, dtype=np.int64).tolist(),
+            tag_map[tag_codes].tolist(),
+            np.asarray(frame_ids, dtype=np.int64).tolist(),
+            file_map[file_codes].tolist()
+            )
+
+        # One transaction for the whole batch
+        self.db.execute("BEGIN")
+        try:
+            self.db.executemany("INSERT INTO bboxes (id, x, y, w, h, tag, frame_id, file) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.db.execute("COMMIT")
+        except sqlite3.Error:
+            self.db.execute("ROLLBACK")
+            raise
+
+        if self.count is not None:
+            self.count += n
+
+        return np.asarray(ids, dtype=np.int64)
+
+    def appendDataFrame(self, df):
+        return self.appendColumns(*getDataFrameColumns(df))
+
+    @timed("dataset.load")
+    def loadDataset(self, file_path, chunk_size=None, progress_callback=None, lock=None):
+        # lock is held while each chunk is inserted, not while it is read
+        lock = lock if lock is not None else contextlib.nullcontext()
+
+        print("Load Dataset")
+
+        print("Before: ", len(self))
+
+        if isBinaryDatasetPath(file_path):
+            count, columns, tags, file_names = readBinaryDataset(file_path)
+            tag_ids = np.array([tag.id for tag in tags], dtype=np.int32)
+            tag_names = np.array([tag.name for tag in tags], dtype=object)
+            file_names = np.array(file_names, dtype=object)
+
+            # Each chunk is inserted in its own transaction
+            chunk_size = chunk_size or 100000
+            for start in range(0, count, chunk_size):
+                chunk = {name: column[start:start + chunk_size] for name, column in columns.items()}
+                with lock:
+                    self.appendColumns(chunk["x"], chunk["y"], chunk["w"], chunk["h"],
+                        tag_ids[chunk["tag"]], tag_names[chunk["tag"]], chunk["frame_id"], file_names[chunk["file"]])
+
+                if progress_callback is not None:
+                    progress_callback(min(start + chunk_size, count), count)
+        else:
+            # Each chunk is inserted in its own transaction
+            for df in readDatasetCSV(file_path, chunk_size or 100000, progress_callback):
+                with lock:
+                    self.appendDataFrame(df)
+
+        print("After: ", len(self))
+
+    def iterDataFrames(self, chunk_size=100000, with_ids=False):
+        query = """
+            SELECT b.x, b.y, b.w, b.h, t.tag_id, t.name AS tag_name, b.frame_id, f.name AS file_name, b.id
+            FROM bboxes b JOIN tags t ON b.tag = t.id JOIN files f ON b.file = f.id
+            ORDER BY b.id
+        """
+        for df in pd.read_sql_query(query, self.db, chunksize=chunk_size):
+            if not with_ids:
+                df = df.drop(columns=["id"])
+            yield df
+
+    def getDataFrame(self, with_ids=False):
+        dfs = list(self.iterDataFrames(with_ids=with_ids))
+        if len(dfs) == 0:
+            return pd.DataFrame(columns=self.headers + (["id"] if with_ids else []))
+        return pd.concat(dfs, ignore_index=True)
+
+    @timed("dataset.save")
+    def saveDataset(self, save_path, lock=None, progress_callback=None):
+        # With lock it is read from a connection of its own instead, WAL
+        # readers see a consistent snapshot without blocking the writer
+        if lock is not None:
+            reader = SQLiteTagDataset(self.db_path)
+            try:
+                reader.saveDataset(save_path, progress_callback=progress_callback)
+            finally:
+                reader.close()
+            return
+
+        if isBinaryDatasetPath(save_path):
+            df = self.getDataFrame(with_ids=True)
+            file_codes, file_uniques = pd.factorize(df["file_name"].to_numpy())
+            tag_codes, tag_uniques = pd.MultiIndex.from_arrays([df["tag_id"].to_numpy(), df["tag_name"].to_numpy()]).factorize()
+
+            columns = {name: df[name].to_numpy() for name in ["x", "y", "w", "h", "frame_id", "id"]}
+            columns["tag"] = tag_codes
+            columns["file"] = file_codes
+
+            writeBinaryDataset(save_path, columns, [Tag(tag_id, tag_name) for tag_id, tag_name in tag_uniques], list(file_uniques))
+            return
+
+        writeDatasetCSV(save_path, self.iterDataFrames(), len(self), progress_callback)
+
+    def getBBoxesDict(self, lock=None):
+        # With lock it is read from a connection of its own, as in saveDataset
+        if lock is not None:
+            reader = SQLiteTagDataset(self.db_path)
+            try:
+                return reader.getBBoxesDict()
+            finally:
+                reader.close()
+
+        df = pd.read_sql_query("""
+            SELECT b.file, b.frame_id, t.tag_id, b.x, b.y, b.w, b.h
+            FROM bboxes b JOIN tags t ON b.tag = t.id
+            ORDER BY b.id
+        """, self.db)
+
+        return groupBBoxes(df["file"].to_numpy(), self.file_names, df["frame_id"].to_numpy(), df["tag_id"].to_numpy(),
+            df["x"].to_numpy(), df["y"].to_numpy(), df["w"].to_numpy(), df["h"].to_numpy())
+
+def groupBBoxes(file_codes, file_names, frame_ids, tag_ids, x, y, w, h):
+    # Bboxes columns as {file_name: {frame_id: [(class_id, x, y, bbox_width, bbox_height)]}},
+    # file_names maps the file codes to names. Repeated bboxes of a frame are
+    # dropped, the others keep their order
+    values = np.stack([file_codes, frame_ids, tag_ids, x, y, w, h], axis=1).astype(np.int64)
+    if len(values) == 0:
+        return {}
+
+    # Repeated bboxes are next to each other in a stable sort, the first one is kept
+    rows = np.lexsort(values.T[::-1])
+    sorted_values = values[rows]
+    rows = rows[np.concatenate([[True], np.any(sorted_values[1:] != sorted_values[:-1], axis=1)])]
+
+    # Grouped by file, in the order files first appear, and frame, in rows
+    # order within a frame
+    file_codes, first_rows = np.unique(values[:, 0], return_index=True)
+    file_order = np.zeros(file_codes.max() + 1, dtype=np.int64)
+    file_order[file_codes] = first_rows
+    rows = rows[np.lexsort((rows, values[rows, 1], file_order[values[rows, 0]]))]
+    values = values[rows]
+
+    # Frames start where the file or the frame id changes
+    starts = [0] + (np.flatnonzero(np.any(values[1:, :2] != values[:-1, :2], axis=1)) + 1).tolist() + [len(values)]
+    bbox_tuples = list(map(tuple, values[:, 2:].tolist()))
+
+    bboxes_dict = {}
+    for start, end in zip(starts[:-1], starts[1:]):
+        file_code, frame_id = values[start, :2].tolist()
+        bboxes_dict.setdefault(file_names[file_code], {})[frame_id] = bbox_tuples[start:end]
+
+    return bboxes_dict
+
+# Binary dataset layout: magic, header size (uint64), JSON header, then each
+# column as a little endian array, aligned to binary_dataset_alignment bytes
+binary_dataset_magic = b"VLBDATA1"
+binary_dataset_alignment = 64
+binary_dataset_dtypes = {
+    "x": "<i4",
+    "y": "<i4",
+    "w": "<i4",
+    "h": "<i4",
+    "tag": "<i4",
+    "frame_id": "<i4",
+    "file": "<i4",
+    "id": "<i8"
+}
+
+def isBinaryDatasetPath(file_path):
+    return file_path.endswith(".vlb")
+
+def alignOffset(offset):
+    return -(-offset // binary_dataset_alignment) * binary_dataset_alignment
+
+def writeBinaryDataset(file_path, columns, tags, file_names):
+    count = len(columns["id"])
+
+    # Column offsets are relative to the end of the header
+    columns_header = {}
+    offset = 0
+    for name, dtype in binary_dataset_dtypes.items():
+        columns_header[name] = {"dtype": dtype, "offset": offset}
+        offset = alignOffset(offset + count * np.dtype(dtype).itemsize)
+
+    header = json.dumps({
+        "count": count,
+        "columns": columns_header,
+        "tags": [[int(tag.id), tag.name] for tag in tags],
+        "files": list(file_names)
+    }).encode()
+
+    data_start = alignOffset(len(binary_dataset_magic) + 8 + len(header))
+
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(binary_dataset_magic)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+
+        for name, dtype in binary_dataset_dtypes.items():
+            f.write(b"\0" * (data_start + columns_header[name]["offset"] - f.tell()))
+            np.ascontiguousarray(columns[name], dtype=dtype).tofile(f)
+
+    os.replace(tmp_path, file_path)
+
+def readBinaryDataset(file_path):
+    # Returns count, columns memory mapped copy-on-write, tags and file names
+    with open(file_path, "rb") as f:
+        if f.read(len(binary_dataset_magic)) != binary_dataset_magic:
+            raise ValueError("{} is not a binary dataset".format(file_path))
+        header_size = int(np.frombuffer(f.read(8), dtype="<u8")[0])
+        header = json.loads(f.read(header_size))
+
+    data_start = alignOffset(len(binary_dataset_magic) + 8 + header_size)
+    count = header["count"]
+
+    columns = {}
+    for name, spec in header["columns"].items():
+        dtype = np.dtype(spec["dtype"])
+        if count == 0:
+            columns[name] = np.zeros(0, dtype=dtype)
+        else:
+            columns[name] = np.memmap(file_path, dtype=dtype, mode="c", offset=data_start + spec["offset"], shape=(count,))
+
+    tags = [Tag(tag_id, tag_name) for tag_id, tag_name in header["tags"]]
+
+    return count, columns, tags, header["files"]
+
+def getDataFrameColumns(df):
+    return (
+        df["x"].to_numpy(),
+        df["y"].to_numpy(),
+        df["w"].to_numpy(),
+        df["h"].to_numpy(),
+        df["tag_id"].to_numpy(),
+        df["tag_name"].to_numpy(),
+        df["frame_id"].to_numpy(),
+        df["file_name"].to_numpy(),
+        df["id"].to_numpy() if "id" in df.columns else None
+        )
+
+def readDatasetCSV(file_path, chunk_size=None, progress_callback=None):
+    # Yield the dataset CSV as DataFrames. With chunk_size the file is read
+    # chunk_size rows at a time and progress_callback(read_bytes, total_bytes)
+    # is called after each chunk
+    read_options = {
+        "usecols": TagDataset.headers,
+        "dtype": {
+            "x": np.int32,
+            "y": np.int32,
+            "w": np.int32,
+            "h": np.int32,
+            "tag_id": np.int32,
+            "tag_name": str,
+            "frame_id": np.int32,
+            "file_name": str
+        },
+        "keep_default_na": False
+    }
+
+    if chunk_size is None:
+        yield pd.read_csv(file_path, **read_options)
+        return
+
+    total_bytes = os.path.getsize(file_path)
+    with open(file_path, "rb") as f:
+        for df in pd.read_csv(f, chunksize=chunk_size, **read_options):
+            yield df
+
+            if progress_callback is not None:
+                progress_callback(min(f.tell(), total_bytes), total_bytes)
+
+def writeDatasetCSV(save_path, dfs, total_rows, progress_callback=None):
+    # Write the DataFrames as one dataset CSV through a temporary file, so a
+    # failed or cancelled save keeps the previous file.
+    # progress_callback(written_rows, total_rows) is called after each one
+    tmp_path = save_path + ".tmp"
+    try:
+        with open(tmp_path, 'w', encoding='UTF8', newline='') as f:
+            header = True
+            written_rows = 0
+            for df in dfs:
+                df.to_csv(f, index=False, header=header)
+                header = False
+
+                written_rows += len(df)
+                if progress_callback is not None:
+                    progress_callback(written_rows, total_rows)
+
+            if header:
+                f.write(",".join(TagDataset.headers) + "\n")
+
+        os.replace(tmp_path, save_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
 def drawBBoxLabel(painter, rect, label = None, color=Qt.red):
     pen = QPen(color, 3) # Set red pen
     painter.setPen(pen)
@@ -706,14 +4099,35 @@ def drawBBoxLabel(painter, rect, label = None, color=Qt.red):
         painter.setPen(pen)
         painter.drawText(rect, label)
 
+def bboxDirtyRect(rect):
+    # Area painted by drawBBoxLabel, including the pen width
+    return rect.normalized().adjusted(-3, -3, 3, 3)
+
 def getBBoxLabelName(rect, tag_name):
     return f"{rect.x()}, {rect.y()}, {rect.width()}, {rect.height()}, {tag_name}"
 
-def parseBBoxLabelName(bbox_label):
-
-    split_txt = bbox_label.replace(" ", "").split(',')
-
-    return {'x': split_txt[0], 'y': split_txt[1], 'w': split_txt[2], 'h': split_txt[3], 'name': split_txt[4]}        
+def createBBoxListItem(bbox_tag):
+    item = QListWidgetItem(getBBoxLabelName(bbox_tag.rect, bbox_tag.tag.name))
+    item.setData(Qt.UserRole, bbox_tag.id)
+    return item
+
+def loadLabels(labels_path):
+    tags = []
+    file = open(labels_path)
+    labels_lines = file.readlines()
+    for _, line in enumerate(labels_lines):
+        if len(line.split(',')) == 2:
+            label_id, label_name = line.rstrip().split(',')
+            tag = Tag(int(label_id), label_name)
+            tags.append(tag)
+    file.close()
+    return tags
+
+def writeLabels(labels_path, tags):
+    with open(labels_path, "w") as file:
+        for tag in tags:
+            if tag.id > 0:
+                file.write(str(tag) + "\n")
 
 def showMessage(message):
     msgBox = QMessageBox()
@@ -730,5 +4144,54 @@ def main():
 
     window.saveLabels()
 
+def exportMain(argv=None):
+    parser = argparse.ArgumentParser(prog="video_labeling.py export", description="Generate a Yolo dataset from a CSV data file without the GUI")
+    parser.add_argument("data_file", help="CSV or binary (.vlb) data file, or SQLite project (.db, .sqlite)")
+    parser.add_argument("--labels", default="labels.txt", help="labels file (default: labels.txt)")
+    parser.add_argument("--output-dir", default="./custom_dataset", help="dataset base directory (default: ./custom_dataset)")
+    parser.add_argument("--dataset-name", default="minesign_dataset", help="dataset name (default: minesign_dataset)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="export processes (default: number of CPUs)")
+    parser.add_argument("--image-format", default="jpg", choices=["jpg", "png", "bmp", "webp"], help="exported images format (default: jpg)")
+    parser.add_argument("--full", action="store_true", help="rewrite every frame instead of only the changed ones")
+    parser.add_argument("--sink", default="zip", choices=["zip", "tar", "dir"], help="write a zip or tar archive in the output directory, or plain files (default: zip)")
+    parser.add_argument("--compress", action="store_true", help="compress archive entries instead of storing them")
+    parser.add_argument("--dedup-distance", type=int, metavar="BITS", help="prune frames within BITS (of 64) of the perceptual hash of a kept frame with similar bboxes")
+    parser.add_argument("--dedup-iou", type=float, default=0.9, help="bboxes overlap needed to prune a frame (default: 0.9)")
+    parser.add_argument("--metrics", metavar="PATH", help="time the export stages and write them to a JSON or CSV file")
+    args = parser.parse_args(argv)
+
+    # Report missing inputs before the dataset is loaded
+    if not os.path.isfile(args.data_file):
+        parser.error("data file {} does not exist".format(args.data_file))
+    try:
+        labels = loadLabels(args.labels)
+    except (OSError, ValueError) as error:
+        parser.error("cannot read labels file {}: {}".format(args.labels, error))
+
+    if args.metrics is not None:
+        metrics.enabled = True
+
+    if args.data_file.endswith((".db", ".sqlite")):
+        tags_dataset = SQLiteTagDataset(args.data_file)
+    else:
+        tags_dataset = TagDataset()
+        tags_dataset.loadDataset(args.data_file)
+
+    # Warn about tags missing in the labels file
+    label_ids = set(tag.id for tag in labels)
+    for tag in tags_dataset.tags:
+        if tag.id > 0 and tag.id not in label_ids:
+            print("Tag {} is not in {}".format(tag, args.labels))
+
+    exporter = YoloExporter(args.output_dir, args.dataset_name, workers=args.workers, image_format=args.image_format, incremental=not args.full, sink=args.sink, compress=args.compress, dedup_distance=args.dedup_distance, dedup_iou=args.dedup_iou)
+    exporter.export(tags_dataset)
+    capture_pool.clear()
+
+    if args.metrics is not None:
+        metrics.dump(args.metrics)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == "export":
+        exportMain(sys.argv[2:])
+    else:
+        main()
\ No newline at end of file